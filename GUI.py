@@ -25,6 +25,7 @@ class MainWindow(QMainWindow):
         self.imgFilePath = ''  # 压缩图片路径
         self.outFilePath = ''  # 生成图片路径
         self.flushLog = True  # 实时打印日志
+        self.process = None  # 正在运行的压缩线程
 
         # 绑定事件处理函数
         selectImgButton = self.ui.selectImgButton
@@ -33,6 +34,8 @@ class MainWindow(QMainWindow):
         quantitylSlider.valueChanged.connect(self.sliderMove)
         compressButton = self.ui.compressButton
         compressButton.clicked.connect(self.compressImg)
+        cancelButton = self.ui.cancelButton
+        cancelButton.clicked.connect(self.cancelCompress)
         openFilePathButton = self.ui.openFilePathButton
         openFilePathButton.clicked.connect(self.openFilePath)
         githubButton = self.ui.githubButton
@@ -61,29 +64,43 @@ class MainWindow(QMainWindow):
         # 生成对应的目标文件路径
         self.outFilePath = ''.join(self.imgFilePath.split('.')[0:-1]) + '-compress' + str(self.quantity) + '.jpg'
         self.ui.logtextBrowser.setText('')
-        # 启用线程进行压缩处理（因为耗时较大
-        process = processImg.Processthread()
-        process._signal.connect(self.writerLog)
-        process.run()
-        process.encodeimg(self.imgFilePath, self.outFilePath, self.quantity)
-
+        self.ui.progressBar.setValue(0)
+        # 启用线程进行压缩处理（因为耗时较大），界面线程只接收日志、进度和结果
+        self.process = processImg.Processthread(self.imgFilePath, self.outFilePath, self.quantity)
+        self.process._signal.connect(self.writerLog)
+        self.process._progress.connect(self.ui.progressBar.setValue)
+        self.process._done.connect(self.compressDone)
+        self.ui.cancelButton.setDisabled(False)
+        self.process.start()
+
+    def cancelCompress(self):
+        if self.process is not None:
+            self.ui.cancelButton.setDisabled(True)
+            self.process.cancel()
+
+    def compressDone(self, stats):  # 压缩线程结束（stats 为 None 表示已取消或失败）
+        self.ui.cancelButton.setDisabled(True)
+        self.ui.compressButton.setDisabled(False)
+        if stats is None:
+            return
         # 显示生成文件信息
         aftFileInfotextBrowser = self.ui.aftFileInfotextBrowser
         aftFileInfotextBrowser.setText(getFileInfo(self.outFilePath))
         showAftImgLabel = self.ui.showAftImgLabel
-        # 显示生成图
-        jpg = QtGui.QPixmap(self.outFilePath).scaled(showAftImgLabel.width(), showAftImgLabel.height())
-        showAftImgLabel.setPixmap(jpg)
+        # 显示生成图（直接使用内存中的 JPEG 字节）
+        jpg = QtGui.QPixmap()
+        jpg.loadFromData(stats.data, 'JPG')
+        showAftImgLabel.setPixmap(jpg.scaled(showAftImgLabel.width(), showAftImgLabel.height()))
 
-        compressButton.setDisabled(False)
+    def closeEvent(self, event):  # 关闭窗口前先停止压缩线程
+        if self.process is not None and self.process.isRunning():
+            self.process.cancel()
+            self.process.wait()
+        event.accept()
 
     def writerLog(self, s):  # 实时显示处理进度
         self.ui.logtextBrowser.append(s)
 
-        # qt中的一个坑。。。折腾了好久，不使用这个函数的话就无法实时显示添加的内容
-        # ref: https://www.it1352.com/2207991.html
-        QtCore.QCoreApplication.processEvents()
-
     def sliderMove(self):  # 绑定压缩质量选择滑块
         quantitylSlider = self.ui.quantitylSlider
         quantityLabel = self.ui.quantityLabel
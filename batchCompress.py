@@ -0,0 +1,169 @@
+"""Compresses whole directories of images from the command line.
+
+    python batchCompress.py photos/ 'scans/**/*.png' -o compressed/ -q 50 -j 8
+
+Files are spread over a pool of worker processes, largest first, and outputs
+that are newer than their input are skipped, so an interrupted run can simply
+be started again.
+"""
+from nativeThreads import limit_native_threads
+
+# 每个进程只用一个 BLAS/OpenMP 线程，并行度全部来自进程池，避免 N 个进程各开 N 个线程
+# 必须在导入 numpy 之前设置（子进程继承这些环境变量；已经设置了的值保持不变）
+limit_native_threads()
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import jpegEncoder
+
+IMAGE_EXTENSIONS = ('.bmp', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.gif', '.webp', '.ppm', '.pgm')
+
+
+def find_inputs(patterns):
+    """Returns (input path, path relative to its root) for every image in the directories, globs and files."""
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for directory, _, filenames in os.walk(pattern):
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(directory, filename)
+                        inputs.append((path, os.path.relpath(path, pattern)))
+        elif glob.has_magic(pattern):
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    inputs.append((path, os.path.basename(path)))
+        elif os.path.isfile(pattern):
+            inputs.append((pattern, os.path.basename(pattern)))
+        else:
+            print('找不到输入：' + pattern, file=sys.stderr)
+    return inputs
+
+
+def is_up_to_date(input_path, output_path):
+    """Whether output_path exists and is at least as new as input_path."""
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+    except OSError:
+        return False
+
+
+def compress_file(input_path, output_path, options):
+    """Encodes one file in a worker process.
+
+    :returns: (input_path, pixels, input bytes, output bytes, error message or None)
+    """
+    # 先写临时文件再改名，中断时不会留下一个看起来“已是最新”的半个文件
+    temporary_path = output_path + '.part'
+    try:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        stats = jpegEncoder.encode(input_path, temporary_path, **options)
+        os.replace(temporary_path, output_path)
+    except Exception as error:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return input_path, 0, 0, 0, '{}: {}'.format(type(error).__name__, error)
+    return (input_path, stats.original_width * stats.original_height, stats.input_size, stats.output_size,
+            None)
+
+
+def run_batch(jobs, options, workers, verbose=False):
+    """Runs (input, output) jobs on a process pool, largest input first.
+
+    At most 2 * workers jobs are queued at a time, so millions of files do not
+    become millions of pending futures.
+    :returns: (pixels, input bytes, output bytes, encoded count, failed count)
+    """
+    jobs = sorted(jobs, key=lambda job: os.path.getsize(job[0]), reverse=True)
+    totals = [0, 0, 0, 0, 0]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        job_iterator = iter(jobs)
+        while True:
+            for input_path, output_path in job_iterator:
+                pending.add(executor.submit(compress_file, input_path, output_path, options))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                input_path, pixels, input_size, output_size, error = future.result()
+                if error is not None:
+                    totals[4] += 1
+                    print('压缩失败：{} ({})'.format(input_path, error), file=sys.stderr)
+                    continue
+                totals[0] += pixels
+                totals[1] += input_size
+                totals[2] += output_size
+                totals[3] += 1
+                if verbose:
+                    print('{} ({} -> {} bytes)'.format(input_path, input_size, output_size))
+    return tuple(totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compresses directories of images to JPEG.')
+    parser.add_argument('inputs', nargs='+', help='input directories, glob patterns or files')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='where to write the JPEGs (directory inputs keep their layout)')
+    parser.add_argument('-q', '--quality', type=int, default=50)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--dct', choices=('float', 'aan'), default='float')
+    parser.add_argument('--sampling', choices=sorted(jpegEncoder.SAMPLING_FACTORS), default='4:4:4')
+    parser.add_argument('--optimize-huffman', action='store_true')
+    parser.add_argument('--target-size', type=int,
+                        help='search the quality so that each output fits in this many bytes (ignores -q)')
+    parser.add_argument('--grayscale', choices=('auto', 'always', 'never'), default='auto',
+                        help='encode only the luminance: for grayscale images (auto), for every image or never')
+    parser.add_argument('--progressive', action='store_true',
+                        help='write progressive JPEGs (implies --optimize-huffman, not with --target-size)')
+    parser.add_argument('--trellis', action='store_true',
+                        help='rate-distortion optimized quantization (smaller files, slower)')
+    parser.add_argument('--force', action='store_true', help='encode even if the output is up to date')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every encoded file')
+    args = parser.parse_args(argv)
+    try:
+        jpegEncoder.check_quality(args.quality)
+    except ValueError as error:
+        parser.error(str(error))
+
+    options = {'quality': args.quality, 'dct': args.dct, 'sampling': args.sampling,
+               'optimize_huffman': args.optimize_huffman, 'target_size': args.target_size,
+               'grayscale': {'auto': None, 'always': True, 'never': False}[args.grayscale],
+               'progressive': args.progressive, 'trellis': args.trellis}
+    jobs = []
+    outputs = set()
+    skipped = 0
+    for input_path, relative_path in find_inputs(args.inputs):
+        output_path = os.path.join(args.output_dir, os.path.splitext(relative_path)[0] + '.jpg')
+        if output_path in outputs:
+            print('跳过重名文件：' + input_path, file=sys.stderr)
+            continue
+        outputs.add(output_path)
+        if not args.force and is_up_to_date(input_path, output_path):
+            skipped += 1
+            continue
+        jobs.append((input_path, output_path))
+
+    start_time = time.time()
+    pixels, input_size, output_size, encoded, failed = run_batch(jobs, options, max(args.workers, 1),
+                                                                 args.verbose)
+    seconds = time.time() - start_time
+
+    print('压缩 {} 个文件，跳过 {} 个（已是最新），失败 {} 个'.format(encoded, skipped, failed))
+    print('耗时 {:.2f} 秒，{:.1f} MP，{:.2f} MP/s（{} 个进程）'.format(
+        seconds, pixels / 1e6, pixels / 1e6 / seconds if seconds else 0.0, args.workers))
+    if input_size:
+        print('{} -> {} bytes，节省 {} bytes（{:.2f}%）'.format(
+            input_size, output_size, input_size - output_size, 100.0 * (input_size - output_size) / input_size))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""Benchmarks the encoder stage by stage and against Pillow's JPEG encoder.
+
+    python benchmark.py -o results.json
+    python benchmark.py --sizes 0.25 1 4 --baseline results.json
+
+The suite is the synthetic images (gradient, noise and flat screenshot-like
+content at every --sizes megapixels) plus the images in testBMP. Each image is
+benchmarked in a fresh process, so the process peak RSS is its own; the
+per-stage peaks come from one more staged run under tracemalloc. With
+--baseline, every stage whose throughput dropped by more than --threshold is
+flagged and the exit status is 1.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import jpegEncoder
+import kernelBackends
+from kernelBackends import get_kernel
+from compressAlgorithm import take_aan_dct_of_component
+from instrumentation import Instrumentation
+from inputImg import SAMPLING_FACTORS, ArraySource, create_mcu_matrices, downsample_band, pad_planes
+
+STAGES = ('plan', 'read', 'blocks', 'dct', 'quantize', 'symbols', 'entropy', 'container')
+SYNTHETIC_KINDS = ('gradient', 'noise', 'flat')
+SYNTHETIC_SIZES = (0.25, 1, 4, 12, 50)
+TEST_IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testBMP')
+# 比基线慢这么多（比例）才算退化；耗时太短的阶段计时噪声大，不参与比较
+REGRESSION_THRESHOLD = 0.10
+MIN_COMPARED_SECONDS = 0.005
+# Pillow 的子采样参数
+PILLOW_SUBSAMPLING = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
+
+
+def peak_rss_mb():
+    """The peak resident set size of this whole process so far, in MB (None where it is not available).
+
+    It only ever grows, so it is a total for the process, not the peak of a stage.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def synthetic_image(kind, megapixels, seed=0):
+    """Returns a 4:3 (height, width, 3) uint8 test image of about megapixels million pixels."""
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+    rng = numpy.random.default_rng(seed)
+    if kind == 'gradient':
+        x = numpy.linspace(0, 255, width, dtype=numpy.float32)
+        y = numpy.linspace(0, 255, height, dtype=numpy.float32)[:, None]
+        pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        pixels[..., 0] = x
+        pixels[..., 1] = y
+        pixels[..., 2] = (x + y) / 2
+    elif kind == 'noise':
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=numpy.uint8)
+    elif kind == 'flat':
+        # 类似截图：浅色背景上的纯色色块，加上一行行细短横线（文字）
+        pixels = numpy.full((height, width, 3), 240, dtype=numpy.uint8)
+        for _ in range(max(8, int(megapixels * 40))):
+            top, left = rng.integers(0, height), rng.integers(0, width)
+            bottom, right = top + rng.integers(8, height // 4 + 9), left + rng.integers(8, width // 4 + 9)
+            pixels[top:bottom, left:right] = rng.integers(0, 256, 3)
+        for top in range(8, height - 2, 20):
+            words = rng.random(width // 8) < 0.6
+            pixels[top:top + 2, :len(words) * 8][:, numpy.repeat(words, 8)] = 30
+    else:
+        raise ValueError('unknown synthetic image kind: ' + kind)
+    return pixels
+
+
+def load_pixels(spec):
+    """Returns the (height, width, 3) uint8 pixels of ('synthetic', kind, megapixels) or ('file', path)."""
+    if spec[0] == 'synthetic':
+        return synthetic_image(spec[1], spec[2])
+    return numpy.asarray(Image.open(spec[1]).convert('RGB'))
+
+
+def run_stages(pixels, quality, sampling, dct, trace_memory=False):
+    """Runs the whole-image encode one stage at a time (as encode_strip_symbols and encode do).
+
+    The plan stage is only slow the first time: later runs get the cached EncodePlan.
+    With trace_memory every stage also records the peak of the memory it
+    allocated on top of what was in use when it started (tracemalloc, which
+    sees the numpy arrays); tracing slows the stages down.
+
+    :returns: (an Instrumentation with a record for every stage, the JPEG bytes)
+    """
+    instrumentation = Instrumentation(trace_memory)
+    h_factor, v_factor = SAMPLING_FACTORS[sampling]
+    transform = take_aan_dct_of_component if dct == 'aan' else get_kernel('dct')
+    quantize = get_kernel('quantize')
+    image = ArraySource(pixels)
+    # 与 encode 相同，补齐成整数个 MCU
+    width = -(-image.width // (8 * h_factor)) * 8 * h_factor
+    height = -(-image.height // (8 * v_factor)) * 8 * v_factor
+
+    with instrumentation.encoding():
+        with instrumentation.stage('plan'):
+            plan = jpegEncoder.get_encode_plan(quality, image.width, image.height, sampling, dct)
+
+        with instrumentation.stage('read'):
+            lum, chromb, chromr = pad_planes(image.read_planes(0, image.height, image.width), width, height)
+
+        with instrumentation.stage('blocks'):
+            components = [create_mcu_matrices(lum, h_factor, v_factor),
+                          create_mcu_matrices(downsample_band(chromb, h_factor, v_factor)),
+                          create_mcu_matrices(downsample_band(chromr, h_factor, v_factor))]
+
+        with instrumentation.stage('dct'):
+            components = [transform(matrices) for matrices in components]
+
+        with instrumentation.stage('quantize'):
+            components = [quantize(components[0], plan.l_reciprocals),
+                          quantize(components[1], plan.c_reciprocals),
+                          quantize(components[2], plan.c_reciprocals)]
+
+        with instrumentation.stage('symbols'):
+            interleaved = numpy.concatenate(components, axis=1).reshape(-1, 8, 8)
+            block_components = numpy.tile(plan.mcu_components, len(components[0]))
+            symbols, bits, classes = get_kernel('symbols')(interleaved, block_components, [0, 0, 0])
+
+        with instrumentation.stage('entropy'):
+            values, lengths = get_kernel('huffman')(symbols, bits, classes, plan.class_tables)
+            scan = get_kernel('pack')(values, lengths).tobytes()
+
+        with instrumentation.stage('container'):
+            data = plan.header() + scan + bytes([0xFF, 0xD9])
+    return instrumentation, data
+
+
+def benchmark_image(spec, options):
+    """Benchmarks one image (runs in its own process) and returns its result dict."""
+    pixels = load_pixels(spec)
+    megapixels = pixels.shape[0] * pixels.shape[1] / 1e6
+    repeat = options['repeat']
+    quality, sampling, dct = options['quality'], options['sampling'], options['dct']
+
+    # 每个阶段取多次运行中最快的一次；跟踪内存会拖慢计时，各阶段的内存峰值另外跑一遍得到
+    stage_seconds = {}
+    for _ in range(repeat):
+        timed, data = run_stages(pixels, quality, sampling, dct)
+        for stage in STAGES:
+            stage_seconds[stage] = min(stage_seconds.get(stage, float('inf')), timed.stages[stage].seconds)
+    traced, _ = run_stages(pixels, quality, sampling, dct, trace_memory=True)
+    stage_memory = dict((stage, traced.stages[stage].peak_memory / (1024.0 * 1024.0)) for stage in STAGES)
+
+    encode_seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stats = jpegEncoder.encode(pixels, quality=quality, sampling=sampling, dct=dct, grayscale=False)
+        encode_seconds = min(encode_seconds, time.perf_counter() - start)
+    assert stats.data == data, 'the staged pipeline no longer matches jpegEncoder.encode'
+
+    pillow_image = Image.fromarray(pixels)
+    pillow_seconds = float('inf')
+    for _ in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        pillow_image.save(output, 'JPEG', quality=options['pillow_quality'],
+                          subsampling=PILLOW_SUBSAMPLING[sampling])
+        pillow_seconds = min(pillow_seconds, time.perf_counter() - start)
+
+    def throughput(seconds):
+        return megapixels / seconds if seconds else None
+
+    return {
+        'image': spec[1] + '-' + str(spec[2]) + 'MP' if spec[0] == 'synthetic' else os.path.basename(spec[1]),
+        'megapixels': megapixels,
+        'width': int(pixels.shape[1]),
+        'height': int(pixels.shape[0]),
+        'stages': {stage: {'seconds': stage_seconds[stage], 'mp_per_s': throughput(stage_seconds[stage]),
+                           'peak_memory_mb': stage_memory[stage]} for stage in STAGES},
+        'total': {'seconds': encode_seconds, 'mp_per_s': throughput(encode_seconds),
+                  'output_bytes': stats.output_size, 'process_peak_rss_mb': peak_rss_mb()},
+        'pillow': {'seconds': pillow_seconds, 'mp_per_s': throughput(pillow_seconds),
+                   'output_bytes': len(output.getvalue())},
+    }
+
+
+def find_regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compares results with a baseline results dict and returns ['image stage: old -> new MP/s', ...].
+
+    Each result also gets a 'regressions' list of its regressed stage names.
+    """
+    baseline_results = dict((result['image'], result) for result in baseline['results'])
+    messages = []
+    for result in results:
+        result['regressions'] = []
+        old = baseline_results.get(result['image'])
+        if old is None:
+            continue
+        compared = [(stage, result['stages'][stage], old['stages'].get(stage)) for stage in STAGES]
+        compared.append(('total', result['total'], old['total']))
+        for stage, new_timing, old_timing in compared:
+            if not old_timing or old_timing['seconds'] < MIN_COMPARED_SECONDS:
+                continue
+            if new_timing['mp_per_s'] < old_timing['mp_per_s'] * (1 - threshold):
+                result['regressions'].append(stage)
+                messages.append('{} {}: {:.2f} -> {:.2f} MP/s'.format(
+                    result['image'], stage, old_timing['mp_per_s'], new_timing['mp_per_s']))
+    return messages
+
+
+def print_result(result):
+    total, pillow = result['total'], result['pillow']
+    print('{:<24} {:6.2f} MP  {:7.2f} MP/s  {:9} bytes   Pillow {:7.2f} MP/s {:9} bytes   process peak RSS {} MB'
+          .format(result['image'], result['megapixels'], total['mp_per_s'], total['output_bytes'],
+                  pillow['mp_per_s'], pillow['output_bytes'],
+                  '?' if total['process_peak_rss_mb'] is None else int(total['process_peak_rss_mb'])))
+    print('    ' + '  '.join('{} {:.3f}s {:.1f}MB'.format(stage, timing['seconds'], timing['peak_memory_mb'])
+                             for stage, timing in ((stage, result['stages'][stage]) for stage in STAGES)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the JPEG encoder stage by stage.')
+    parser.add_argument('--sizes', type=float, nargs='*', default=list(SYNTHETIC_SIZES),
+                        help='megapixel sizes of the synthetic images')
+    parser.add_argument('--kinds', nargs='*', choices=SYNTHETIC_KINDS, default=list(SYNTHETIC_KINDS))
+    parser.add_argument('--no-test-images', action='store_true', help='skip the images in testBMP')
+    parser.add_argument('--quality', type=int, default=50)
+    parser.add_argument('--pillow-quality', type=int, default=50,
+                        help='quality for Pillow (its 50 uses the same standard tables as our 50)')
+    parser.add_argument('--sampling', choices=sorted(SAMPLING_FACTORS), default='4:4:4')
+    parser.add_argument('--dct', choices=('float', 'aan'), default='float')
+    parser.add_argument('--backend', default=os.environ.get(kernelBackends.BACKEND_VARIABLE,
+                                                            kernelBackends.DEFAULT_BACKEND),
+                        help='the kernel backends, e.g. numpy, reference or numpy,pack=numba (see kernelBackends)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (the fastest is kept)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='a results JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='throughput drop (fraction) that counts as a regression')
+    args = parser.parse_args(argv)
+    try:
+        # 通过环境变量传给每幅图像的子进程
+        kernelBackends.select_backends(args.backend)
+    except ValueError as error:
+        parser.error(str(error))
+
+    specs = [('synthetic', kind, size) for size in args.sizes for kind in args.kinds]
+    if not args.no_test_images:
+        specs += [('file', path) for path in sorted(glob.glob(os.path.join(TEST_IMAGE_DIR, '*')))]
+    options = {'quality': args.quality, 'pillow_quality': args.pillow_quality, 'sampling': args.sampling,
+               'dct': args.dct, 'repeat': max(args.repeat, 1), 'backend': args.backend}
+
+    results = []
+    for spec in specs:
+        # 每幅图像用一个新进程，峰值内存互不影响；内存不足被杀掉时只影响这一幅
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                result = executor.submit(benchmark_image, spec, options).result()
+        except Exception as error:
+            print('{}: 失败 ({}: {})'.format(spec[1:], type(error).__name__, error), file=sys.stderr)
+            continue
+        print_result(result)
+        results.append(result)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.threshold)
+        print('与基线相比退化 {} 处'.format(len(regressions)))
+        for message in regressions:
+            print('    ' + message)
+
+    if args.output:
+        report = {
+            'environment': {'python': platform.python_version(), 'numpy': numpy.__version__,
+                            'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                            'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'options': options,
+            'results': results,
+        }
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
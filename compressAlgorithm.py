@@ -1,13 +1,18 @@
 """Implements the JPEG compression algorithm."""
 import numpy
 
-from huffmanTables import JPEG_HUFFMAN_DC_LUM, JPEG_HUFFMAN_AC_LUM
-from utils import ZIGZAG_ORDER
-from utils import get_magnitude_dc, get_ones_complement_bit_string
+from huffmanTables import JPEG_HUFFMAN_DC_LUM_LOOKUP, JPEG_HUFFMAN_AC_LUM_LOOKUP
+from utils import ZIGZAG_ORDER, ZIGZAG_INDEX
+from utils import MAGNITUDE_OFFSET, MAGNITUDE_CATEGORY, MAGNITUDE_BITS
 
 # Set numpy printing options to print floats reasonably
 numpy.set_printoptions(precision=2, suppress=True)
 
+# 率失真优化量化时误差（以 DC 量化步长的平方为单位）折合多少位，越大越接近直接取整
+TRELLIS_LAMBDA = 2.0
+# 率失真优化量化每次一起处理的块数
+TRELLIS_CHUNK_BLOCKS = 2048
+
 # 亮度量化矩阵
 L_QUANTIZATION_TABLE = numpy.array([[16, 11, 10, 16, 24, 40, 51, 61],
                                     [12, 12, 14, 19, 26, 58, 60, 55],
@@ -28,54 +33,231 @@ C_QUANTIZATION_TABLE = numpy.array([[17, 18, 24, 47, 99, 99, 99, 99],
                                     [99, 99, 99, 99, 99, 99, 99, 99]])
 
 # 初始化用于DCT变换的矩阵 ref: https://blog.csdn.net/ahafg/article/details/48808443
-DCT_TABLE = numpy.array([[0.35, 0.35, 0.35, 0.35, 0.35, 0.35, 0.35, 0.35],
-                         [0.49, 0.42, 0.28, 0.1, -0.1, -0.28, -0.42, -0.49],
-                         [0.46, 0.19, -0.19, -0.46, -0.46, -0.19, 0.19, 0.46],
-                         [0.42, -0.1, -0.49, -0.28, 0.28, 0.49, 0.1, -0.42],
-                         [0.35, -0.35, -0.35, 0.35, 0.35, -0.35, -0.35, 0.35],
-                         [0.28, -0.49, 0.1, 0.42, -0.42, -0.1, 0.49, -0.28],
-                         [0.19, -0.46, 0.46, -0.19, -0.19, 0.46, -0.46, 0.19],
-                         [0., -0.28, 0.42, -0.49, 0.49, -0.42, 0.28, -0.1]])
+# C[u][x] = c(u) * cos((2x + 1) * u * pi / 16)，c(0) = sqrt(1/8)，其余 c(u) = sqrt(2/8)
+# 直接按公式计算，不再使用保留两位小数的近似值
+DCT_TABLE = numpy.sqrt(2 / 8) * numpy.cos(numpy.outer(numpy.arange(8), 2 * numpy.arange(8) + 1) * numpy.pi / 16)
+DCT_TABLE[0] = numpy.sqrt(1 / 8)
 
 
 def scale_quant_tables(quanlity, l_quant_tables, c_quant_tables):
-    for i in range(64):
-        if quanlity > 50:
-            tmpl = l_quant_tables[int(i / 8)][i % 8] + 1.64 * (quanlity - 50)
-            tmpc = c_quant_tables[int(i / 8)][i % 8] + 1.64 * (quanlity - 50)
-        else:
-            tmpl = l_quant_tables[int(i / 8)][i % 8] - 2.4 * (50 - quanlity)
-            tmpc = c_quant_tables[int(i / 8)][i % 8] - 1.96 * (50 - quanlity)
+    """Returns new luminance and chrominance tables scaled by the quality factor.
+
+    The arguments are left unchanged. Entries are truncated to integers and
+    clamped to the 1..255 range a baseline DQT segment can hold.
+    """
+    l_quant_tables = numpy.asarray(l_quant_tables)
+    c_quant_tables = numpy.asarray(c_quant_tables)
+    if quanlity > 50:
+        scaled_l = l_quant_tables + 1.64 * (quanlity - 50)
+        scaled_c = c_quant_tables + 1.64 * (quanlity - 50)
+    else:
+        scaled_l = l_quant_tables - 2.4 * (50 - quanlity)
+        scaled_c = c_quant_tables - 1.96 * (50 - quanlity)
+    # 先截断取整再限制范围，避免出现 0 值（原来 (0,1) 之间的值取整后会变成 0）
+    scaled_l = numpy.clip(numpy.trunc(scaled_l), 1, 255).astype(l_quant_tables.dtype)
+    scaled_c = numpy.clip(numpy.trunc(scaled_c), 1, 255).astype(c_quant_tables.dtype)
+    return [scaled_l, scaled_c]
+
+
+def take_dct_of_component(component, dtype=numpy.float64):
+    """Takes the DCT of a whole (..., 8, 8) component stack in one batched call.
+
+    :param component: the level-shifted blocks of a color component.
+    :param dtype: numpy.float64 (default) or numpy.float32 for a faster, lower precision transform.
+    :returns: numpy.ndarray -- the (N, 8, 8) stack of DCT coefficients.
+    """
+    # 二维离散变换就是左乘DCT变换矩阵再右乘其转置，matmul 会对整个块序列广播
+    table = DCT_TABLE.astype(dtype)
+    return numpy.matmul(numpy.matmul(table, numpy.asarray(component, dtype=dtype)), table.T)
+
+
+# AAN (Arai-Agui-Nakajima) 快速DCT的定点参数：乘法常数放大 2^AAN_CONST_BITS 倍，
+# 输入先左移 AAN_PASS_BITS 位以保留精度 ref: libjpeg jfdctfst.c
+AAN_CONST_BITS = 13
+AAN_PASS_BITS = 4
+FIX_0_382683433 = int(round(0.382683433 * (1 << AAN_CONST_BITS)))
+FIX_0_541196100 = int(round(0.541196100 * (1 << AAN_CONST_BITS)))
+FIX_0_707106781 = int(round(0.707106781 * (1 << AAN_CONST_BITS)))
+FIX_1_306562965 = int(round(1.306562965 * (1 << AAN_CONST_BITS)))
+# AAN 的输出相当于真实DCT系数乘以 8 * s(u) * s(v)，s(0) = 1，s(k) = sqrt(2) * cos(k * pi / 16)
+AAN_SCALE_FACTORS = numpy.array([1.0] + [numpy.sqrt(2) * numpy.cos(k * numpy.pi / 16) for k in range(1, 8)])
+# 与 take_dct_of_component 的浮点结果相比，折算回真实DCT系数后的最大绝对误差（8位输入）
+AAN_MAX_ERROR = 0.5
+
+
+def _aan_multiply(value, constant):
+    """Fixed point multiply, rounding off the AAN_CONST_BITS fraction bits."""
+    return (value * constant + (1 << (AAN_CONST_BITS - 1))) >> AAN_CONST_BITS
+
+
+def _aan_pass(data):
+    """Runs the 1-D AAN butterflies along the last axis of every block."""
+    out = numpy.empty_like(data)
+    tmp0 = data[..., 0] + data[..., 7]
+    tmp7 = data[..., 0] - data[..., 7]
+    tmp1 = data[..., 1] + data[..., 6]
+    tmp6 = data[..., 1] - data[..., 6]
+    tmp2 = data[..., 2] + data[..., 5]
+    tmp5 = data[..., 2] - data[..., 5]
+    tmp3 = data[..., 3] + data[..., 4]
+    tmp4 = data[..., 3] - data[..., 4]
+
+    # Even part
+    tmp10 = tmp0 + tmp3
+    tmp13 = tmp0 - tmp3
+    tmp11 = tmp1 + tmp2
+    tmp12 = tmp1 - tmp2
+    out[..., 0] = tmp10 + tmp11
+    out[..., 4] = tmp10 - tmp11
+    z1 = _aan_multiply(tmp12 + tmp13, FIX_0_707106781)
+    out[..., 2] = tmp13 + z1
+    out[..., 6] = tmp13 - z1
+
+    # Odd part
+    tmp10 = tmp4 + tmp5
+    tmp11 = tmp5 + tmp6
+    tmp12 = tmp6 + tmp7
+    z5 = _aan_multiply(tmp10 - tmp12, FIX_0_382683433)
+    z2 = _aan_multiply(tmp10, FIX_0_541196100) + z5
+    z4 = _aan_multiply(tmp12, FIX_1_306562965) + z5
+    z3 = _aan_multiply(tmp11, FIX_0_707106781)
+    z11 = tmp7 + z3
+    z13 = tmp7 - z3
+    out[..., 5] = z13 + z2
+    out[..., 3] = z13 - z2
+    out[..., 1] = z11 + z4
+    out[..., 7] = z11 - z4
+    return out
+
 
-        if tmpl <= 0:
-            tmpl = 1
-        elif tmpl > 255:
-            tmpl = 255
-        if tmpc <= 0:
-            tmpc = 1
-        elif tmpc > 255:
-            tmpc = 255
+def take_aan_dct_of_component(component):
+    """Takes a fixed-point AAN fast DCT of a whole (..., 8, 8) component stack.
 
-        l_quant_tables[int(i / 8)][i % 8] = tmpl
-        c_quant_tables[int(i / 8)][i % 8] = tmpc
+    The output is left unscaled (5 multiplies per 8 points instead of 64):
+    each coefficient must be divided by the matching entry of
+    aan_quantization_table, which folds the AAN post-scaling into the
+    quantization step. After that the result is within AAN_MAX_ERROR of the
+    float DCT from take_dct_of_component.
+    :param component: the level-shifted (integer valued) blocks of a color component.
+    :returns: numpy.ndarray -- the (N, 8, 8) int32 stack of scaled coefficients.
+    """
+    data = numpy.rint(component).astype(numpy.int32) << AAN_PASS_BITS
+    # 先对每行、再对每列做一维变换
+    data = _aan_pass(data)
+    data = _aan_pass(data.swapaxes(-1, -2)).swapaxes(-1, -2)
+    return data
 
-    return [l_quant_tables, c_quant_tables]
 
+def aan_quantization_table(quantization_table):
+    """Returns the quantization table with the AAN post-scaling folded in."""
+    scale = numpy.outer(AAN_SCALE_FACTORS, AAN_SCALE_FACTORS) * (8 << AAN_PASS_BITS)
+    return numpy.asarray(quantization_table) * scale
 
-def take_dct_of_component(component):
-    """Selects which DCT to use (mine or scipy's FCT)."""
-    for index, matrix in enumerate(component):
-        # 分两步进行，因为是二维离散变换，其实就是乘以了DCT变换矩阵
-        res = numpy.dot(DCT_TABLE, matrix)
-        component[index] = numpy.dot(res, numpy.transpose(DCT_TABLE))
-        # 运用这个库函数进行dct变换会更快
-        # component[index] = scipy.fftpack.dct(scipy.fftpack.dct(matrix.T, norm='ortho').T, norm='ortho')
 
+def quantization_reciprocals(quantization_table):
+    """Precomputes the reciprocals of a quantization table (multiplying is cheaper than dividing)."""
+    return 1.0 / numpy.asarray(quantization_table, dtype=numpy.float64)
 
-def quantize_component(component, quantization_table):
-    """Quantizes a whole color component (this should be a list matrices)."""
-    for index, matrix in enumerate(component):
-        component[index] = matrix / quantization_table
+
+def quantize_component(component, reciprocal_table):
+    """Quantizes a whole color component (an (N, 8, 8) stack of blocks).
+
+    :param component: the DCT coefficients of the component.
+    :param reciprocal_table: the reciprocals of the quantization table (see quantization_reciprocals).
+    :returns: numpy.ndarray -- the (N, 8, 8) stack of rounded int16 coefficients.
+    """
+    # 乘以倒数后四舍五入（而不是直接截断），量化后的系数在 int16 范围内
+    quantized = numpy.multiply(component, reciprocal_table)
+    numpy.rint(quantized, out=quantized)
+    return quantized.astype(numpy.int16)
+
+
+def trellis_quantize_component(component, reciprocal_table, quantization_table, ac_code_lengths,
+                               rdo_lambda=TRELLIS_LAMBDA):
+    """Quantizes a whole color component, choosing the AC values that minimize rate + lambda * distortion.
+
+    For every block a dynamic program over the zigzag positions decides which
+    coefficients stay nonzero and whether each is rounded to nearest or one
+    step towards zero. The rate is the huffman code length of the (run, size)
+    symbols, ZRLs and EOB plus the extra bits; the distortion is the squared
+    error of the coefficients in units of the squared DC step, so the
+    trade-off follows the coarseness of the table. DC terms are rounded as in
+    quantize_component.
+    :param component: the DCT coefficients of the component.
+    :param reciprocal_table: the reciprocals of the quantization table (see quantization_reciprocals).
+    :param quantization_table: the (8, 8) quantization table written to the file (without AAN scaling).
+    :param ac_code_lengths: the (256,) code length of each AC symbol (0 if it has no code).
+    :param rdo_lambda: the bits one squared DC step of error is worth.
+    :returns: numpy.ndarray -- the rounded int16 coefficients, shaped like component.
+    """
+    shape = component.shape
+    values = numpy.multiply(component, reciprocal_table).reshape(-1, 64)[:, ZIGZAG_INDEX]
+    quantized = numpy.rint(values)
+    magnitudes = numpy.abs(values)
+    rounded = quantized[:, 1:] != 0
+    # 没有码字的符号不能选；(0, 0) 为 EOB、(15, 0) 为 ZRL
+    code_lengths = numpy.where(ac_code_lengths > 0, ac_code_lengths, numpy.inf)
+    eob_length, zrl_length = code_lengths[0x00], code_lengths[0xF0]
+    # 每个系数的误差乘以它的步长平方（即系数本身的误差），再以 DC 步长的平方为单位：低频步长为 1、
+    # 高频步长很大的细表不会为了省几位去掉代价很大的高频系数
+    steps = numpy.asarray(quantization_table, dtype=numpy.float64).reshape(64)[ZIGZAG_INDEX]
+    weights = rdo_lambda * (steps / steps[0]) ** 2
+
+    # 按最后一个非零系数的位置排序分组，每组只需算到组内最大的位置；全零的块不用处理
+    last_positions = numpy.where(rounded.any(axis=1), 63 - numpy.argmax(rounded[:, ::-1], axis=1), 0)
+    order = numpy.argsort(last_positions, kind='stable')
+    order = order[last_positions[order] > 0]
+    quantized[order, 1:] = 0
+    for begin in range(0, len(order), TRELLIS_CHUNK_BLOCKS):
+        rows = order[begin:begin + TRELLIS_CHUNK_BLOCKS]
+        count, end = len(rows), last_positions[rows[-1]] + 1
+        block_magnitudes = magnitudes[rows, :end]
+        # zero_costs[:, k]：第 1 到 k 个系数全部取零的失真代价
+        zero_costs = numpy.cumsum(weights[:end] * block_magnitudes ** 2, axis=1)
+        zero_costs[:, 0] = 0
+        # 每个系数的两个候选幅值：四舍五入的值和再小一的值（为 0 的候选不可用）
+        candidates = []
+        for candidate in (numpy.rint(block_magnitudes), numpy.rint(block_magnitudes) - 1):
+            sizes = numpy.frexp(candidate)[1]
+            costs = weights[:end] * (block_magnitudes - candidate) ** 2 + sizes
+            costs[candidate <= 0] = numpy.inf
+            candidates.append((candidate, sizes, costs))
+
+        # best[:, k]：第 k 个系数为最后一个非零系数时前 k 个系数的最小代价，k = 0 表示只有 DC
+        best = numpy.full((count, end), numpy.inf)
+        best[:, 0] = 0
+        previous = numpy.zeros((count, end), dtype=numpy.int64)
+        chosen = numpy.zeros((count, end))
+        block_indexes = numpy.arange(count)
+        for position in range(1, end):
+            runs = position - 1 - numpy.arange(position)
+            base = best[:, :position] - zero_costs[:, :position] + zero_costs[:, position - 1:position]
+            base += (runs >> 4) * zrl_length
+            for candidate, sizes, costs in candidates:
+                symbols = ((runs & 0x0F) << 4)[None, :] + sizes[:, position:position + 1].astype(numpy.int64)
+                total = base + numpy.take(code_lengths, symbols) + costs[:, position:position + 1]
+                arguments = numpy.argmin(total, axis=1)
+                minimums = total[block_indexes, arguments]
+                better = minimums < best[:, position]
+                best[better, position] = minimums[better]
+                previous[better, position] = arguments[better]
+                chosen[better, position] = candidate[better, position]
+
+        # 在最后一个非零系数之后写 EOB（第 63 位为非零时不写），之后的系数都取零
+        totals = best + zero_costs[:, -1:] - zero_costs + numpy.where(numpy.arange(end) < 63, eob_length, 0)
+        positions = numpy.argmin(totals, axis=1)
+        while True:
+            live = positions > 0
+            if not live.any():
+                break
+            block_rows, block_positions = rows[live], positions[live]
+            quantized[block_rows, block_positions] = numpy.copysign(chosen[live, block_positions],
+                                                                    values[block_rows, block_positions])
+            positions[live] = previous[live, block_positions]
+
+    result = numpy.empty_like(quantized)
+    result[:, ZIGZAG_INDEX] = quantized
+    return result.reshape(shape).astype(numpy.int16)
 
 
 def encode_dc(component):
@@ -88,7 +270,7 @@ def encode_dc(component):
 
 
 def zigzag_all(interleaved):
-    """Zigzag all of the blocks (creating a list of lists)."""
+    """Zigzag all of the blocks of an (N, 8, 8) stack (creating a list of lists)."""
     zigzaged_lists = []
     for matrix in interleaved:
         zigzaged_matrix = []
@@ -99,15 +281,18 @@ def zigzag_all(interleaved):
 
 
 def run_length_encode(serial_list):
-    """Perform run length encoding on a serialized block."""
+    """Perform run length encoding on a serialized block.
+
+    Returns a list of (symbol, extra bits) tuples, the number of extra bits
+    being the low nibble of the symbol.
+    """
     serial_index = 0
     run_length = []
     while serial_index < 64:
         if serial_index == 0:
-            value = serial_list[serial_index]
+            value = serial_list[serial_index] + MAGNITUDE_OFFSET
             # 如果是第一个数，则只用添加 （二进制下的长度，二进制流）
-            run_length.append((get_magnitude_dc(value),
-                               get_ones_complement_bit_string(value)))
+            run_length.append((int(MAGNITUDE_CATEGORY[value]), int(MAGNITUDE_BITS[value])))
             serial_index += 1
             continue
         zero_count = 0
@@ -115,36 +300,232 @@ def run_length_encode(serial_list):
             zero_count += 1
             serial_index += 1
         if serial_index == 64:  # Rest of the block is zero
-            run_length.append((0x00, ''))
+            run_length.append((0x00, 0))
             break
         while zero_count > 15:  # Encode as 16 zeroes as needed till nonzero
-            run_length.append((0xF0, ''))
+            run_length.append((0xF0, 0))
             zero_count -= 16
-        nonzero_value = serial_list[serial_index]
+        nonzero_value = serial_list[serial_index] + MAGNITUDE_OFFSET
         zero_count <<= 4
-        zrl = zero_count | get_magnitude_dc(nonzero_value)
-        run_length.append((zrl,
-                           get_ones_complement_bit_string(nonzero_value)))
+        zrl = zero_count | int(MAGNITUDE_CATEGORY[nonzero_value])
+        run_length.append((zrl, int(MAGNITUDE_BITS[nonzero_value])))
         serial_index += 1
     return run_length
 
 
-def huffman_encode(run_length):
-    """Replace the symbols with their appropriate huffman code."""
-    for index, tup in enumerate(run_length):
-        # Just using the luminance tables for simplicity
+def huffman_encode(run_length, dc_table=JPEG_HUFFMAN_DC_LUM_LOOKUP, ac_table=JPEG_HUFFMAN_AC_LUM_LOOKUP):
+    """Replace the symbols with their (code, code length, extra bits, extra bit length).
+
+    dc_table and ac_table are the compiled (codes, lengths) tables of the
+    block's component (the luminance tables by default).
+    """
+    dc_codes, dc_lengths = dc_table
+    ac_codes, ac_lengths = ac_table
+    for index, (symbol, bits) in enumerate(run_length):
         if index == 0:
-            tup = run_length[index]
-            run_length[index] = (JPEG_HUFFMAN_DC_LUM[tup[0]], tup[1])
+            run_length[index] = (int(dc_codes[symbol]), int(dc_lengths[symbol]), bits, symbol & 0x0F)
         else:
-            tup = run_length[index]
-            run_length[index] = (JPEG_HUFFMAN_AC_LUM[tup[0]], tup[1])
+            run_length[index] = (int(ac_codes[symbol]), int(ac_lengths[symbol]), bits, symbol & 0x0F)
 
 
 def dump_scan_to_string(run_lengthed_lists):
     """Dump the whole scan into a 'binary' string."""
     scan_string = ''
     for run_length in run_lengthed_lists:
-        for mag, literal in run_length:
-            scan_string += mag + literal
+        for code, length, bits, bits_length in run_length:
+            scan_string += format(code, '0{}b'.format(length))
+            if bits_length:
+                scan_string += format(bits, '0{}b'.format(bits_length))
     return scan_string
+
+
+def generate_symbols(blocks, block_components, dc_predictors=None):
+    """Turns a whole scan of quantized blocks into flat arrays of entropy coding symbols.
+
+    Performs DPCM on the DC terms (per component), zigzag reordering and run
+    length encoding (including ZRL and EOB) for every block at once.
+    :param blocks: the (N, 8, 8) int16 blocks in scan (interleaved) order.
+    :param block_components: the (N,) component index of each block.
+    :param dc_predictors: optional list of the previous DC value of each
+        component, used to continue a scan; it is updated in place.
+    :returns: tuple -- (symbols, bits, classes) arrays with one entry per
+        symbol. The number of extra bits is the low nibble of the symbol and
+        the class is 2 * component for DC symbols and 2 * component + 1 for AC.
+    """
+    count = len(blocks)
+    block_components = numpy.asarray(block_components)
+    serial = blocks.reshape(count, 64)[:, ZIGZAG_INDEX].astype(numpy.int32)
+
+    # DPCM：每个通道的DC减去同一通道上一个块的DC
+    dc_values = serial[:, 0]
+    dc_diffs = numpy.empty(count, dtype=numpy.int32)
+    for component in numpy.unique(block_components):
+        mask = block_components == component
+        values = dc_values[mask]
+        previous = dc_predictors[component] if dc_predictors is not None else 0
+        dc_diffs[mask] = numpy.diff(values, prepend=previous)
+        if dc_predictors is not None:
+            dc_predictors[component] = int(values[-1])
+
+    # 行程长度编码：由非零AC系数的位置得到前面的零个数
+    ac = serial[:, 1:]
+    rows, columns = numpy.nonzero(ac)
+    positions = columns + 1
+    first_in_block = numpy.ones(len(rows), dtype=bool)
+    first_in_block[1:] = rows[1:] != rows[:-1]
+    last_in_block = numpy.ones(len(rows), dtype=bool)
+    last_in_block[:-1] = first_in_block[1:]
+    previous_positions = numpy.empty_like(positions)
+    previous_positions[1:] = positions[:-1]
+    previous_positions[first_in_block] = 0
+    runs = positions - previous_positions - 1
+    zrl_counts = runs >> 4  # 每 16 个零先写一个 ZRL
+    ac_values = ac[rows, columns] + MAGNITUDE_OFFSET
+    ac_symbols = ((runs & 0x0F) << 4) | MAGNITUDE_CATEGORY[ac_values]
+
+    # 最后一个非零系数不在第 63 位的块（包括全零的块）以 EOB 结尾
+    last_positions = numpy.zeros(count, dtype=positions.dtype)
+    last_positions[rows[last_in_block]] = positions[last_in_block]
+    eob = last_positions < 63
+
+    # 计算每个符号在输出中的位置：块内依次是 DC、(ZRL..., AC)...、EOB
+    event_counts = zrl_counts + 1
+    block_event_counts = numpy.bincount(rows, weights=event_counts, minlength=count).astype(numpy.int64)
+    block_counts = 1 + block_event_counts + eob
+    block_starts = numpy.cumsum(block_counts) - block_counts
+    event_starts = numpy.cumsum(event_counts) - event_counts
+    block_event_starts = numpy.cumsum(block_event_counts) - block_event_counts
+    event_starts += block_starts[rows] + 1 - block_event_starts[rows]
+
+    total = int(block_counts.sum())
+    symbols = numpy.zeros(total, dtype=numpy.uint8)  # EOB 即为 0x00
+    bits = numpy.zeros(total, dtype=numpy.uint16)
+    dc_values = dc_diffs + MAGNITUDE_OFFSET
+    symbols[block_starts] = MAGNITUDE_CATEGORY[dc_values]
+    bits[block_starts] = MAGNITUDE_BITS[dc_values]
+    symbols[event_starts + zrl_counts] = ac_symbols
+    bits[event_starts + zrl_counts] = MAGNITUDE_BITS[ac_values]
+    if len(zrl_counts) and zrl_counts.max():
+        zrl_total = int(zrl_counts.sum())
+        zrl_offsets = numpy.arange(zrl_total) - numpy.repeat(numpy.cumsum(zrl_counts) - zrl_counts, zrl_counts)
+        symbols[numpy.repeat(event_starts, zrl_counts) + zrl_offsets] = 0xF0
+
+    classes = numpy.repeat(block_components.astype(numpy.uint8) * 2, block_counts) + 1
+    classes[block_starts] -= 1
+    return symbols, bits, classes
+
+
+def count_class_frequencies(symbols, classes, class_count):
+    """Counts how often each symbol occurs in each symbol class, as a (class_count, 256) array."""
+    counts = numpy.bincount(classes.astype(numpy.int64) * 256 + symbols, minlength=class_count * 256)
+    return counts.reshape(class_count, 256)
+
+
+def count_scan_bits(frequencies, class_tables):
+    """Returns how many bits the counted symbols take once huffman coded (code words plus extra bits).
+
+    :param frequencies: the (class_count, 256) symbol counts (see count_class_frequencies).
+    :param class_tables: the compiled (codes, lengths) table of each symbol class.
+    """
+    # 不生成码字也能算出扫描数据的长度（不含末尾补齐和 0xFF 后填充的 0x00）
+    code_lengths = numpy.stack([table[1] for table in class_tables]).astype(numpy.int64)
+    extra_lengths = numpy.arange(256) & 0x0F
+    return int((frequencies * (code_lengths + extra_lengths)).sum())
+
+
+def huffman_encode_symbols(symbols, bits, classes, class_tables):
+    """Looks up the huffman code of every symbol and appends its extra bits.
+
+    :param class_tables: the compiled (codes, lengths) table of each symbol class.
+    :returns: tuple -- (values, lengths) arrays, the bits of each code word
+        right aligned in values.
+    """
+    codes = numpy.stack([table[0] for table in class_tables])
+    code_lengths = numpy.stack([table[1] for table in class_tables])
+    extra_lengths = symbols & 0x0F
+    values = (codes[classes, symbols] << extra_lengths) | bits
+    lengths = code_lengths[classes, symbols] + extra_lengths
+    return values, lengths
+
+
+def _pack_raw_bits(values, lengths):
+    """Packs right aligned code words into bytes, without padding or byte stuffing.
+
+    :returns: tuple -- (the uint8 array, the total number of bits).
+    """
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    offsets = numpy.cumsum(lengths) - lengths
+    total_bits = int(offsets[-1] + lengths[-1]) if len(lengths) else 0
+    byte_count = (total_bits + 7) // 8
+    # 把每个码字移到一个 64 位窗口中它所在的位置，窗口从它的第一个字节开始
+    starts = offsets >> 3
+    shifts = (64 - (offsets & 7) - lengths).astype(numpy.uint64)
+    aligned = numpy.asarray(values, dtype=numpy.uint64) << shifts
+    packed = numpy.zeros(byte_count, dtype=numpy.float64)
+    # 码字之间的位互不重叠，因此同一字节上的各部分可以直接相加
+    max_length = int(lengths.max()) if len(lengths) else 0
+    for index in range((max_length + 7 + 7) // 8):
+        parts = (aligned >> numpy.uint64(56 - 8 * index)) & numpy.uint64(0xFF)
+        positions = starts + index
+        used = positions < byte_count
+        packed += numpy.bincount(positions[used], weights=parts[used], minlength=byte_count)
+    return packed.astype(numpy.uint8), total_bits
+
+
+def stuff_bytes(packed):
+    """Zero pads any 0xFF bytes of an entropy coded segment."""
+    return numpy.insert(packed, numpy.flatnonzero(packed == 0xFF) + 1, 0)
+
+
+def pack_bits(values, lengths):
+    """Packs the code words of a scan into bytes, ready to be written to the file.
+
+    Each code word is placed at its bit offset (a cumulative sum of the
+    lengths), the last byte is padded with 1 bits and every 0xFF byte is
+    followed by a stuffed 0x00.
+    :param values: the right aligned code words (at most 32 bits each).
+    :param lengths: the bit length of each code word.
+    :returns: numpy.ndarray -- the uint8 entropy coded segment.
+    """
+    packed, total_bits = _pack_raw_bits(values, lengths)
+
+    # Add throw away bits to make it end on a byte
+    if total_bits % 8:
+        packed[-1] |= (1 << (8 - total_bits % 8)) - 1
+
+    return stuff_bytes(packed)
+
+
+class EntropyWriter(object):
+    """Packs a scan into bytes piece by piece (e.g. one MCU row at a time).
+
+    The bits of the last, incomplete byte are carried over to the next call
+    to write, so the output is the same as packing the whole scan at once.
+    """
+
+    def __init__(self):
+        self.carry_value = 0
+        self.carry_length = 0
+
+    def write(self, values, lengths):
+        """Packs the code words and returns the complete (byte stuffed) bytes."""
+        values = numpy.concatenate(([self.carry_value], values)).astype(numpy.uint64)
+        lengths = numpy.concatenate(([self.carry_length], lengths))
+        packed, total_bits = _pack_raw_bits(values, lengths)
+        self.carry_length = total_bits % 8
+        if self.carry_length:
+            self.carry_value = int(packed[-1]) >> (8 - self.carry_length)
+            packed = packed[:-1]
+        else:
+            self.carry_value = 0
+        return stuff_bytes(packed)
+
+    def flush(self):
+        """Returns the last byte, padded with 1 bits (empty if the scan ended on a byte)."""
+        if not self.carry_length:
+            return numpy.zeros(0, dtype=numpy.uint8)
+        padding = 8 - self.carry_length
+        last = (self.carry_value << padding) | ((1 << padding) - 1)
+        self.carry_value = 0
+        self.carry_length = 0
+        return stuff_bytes(numpy.array([last], dtype=numpy.uint8))
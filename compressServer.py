@@ -0,0 +1,577 @@
+"""Serves the encoder over HTTP, for local use and load tests (asyncio, no external services).
+
+    python compressServer.py --port 8080 --workers 4 --queue 8
+    curl --data-binary @photo.png 'http://127.0.0.1:8080/compress?quality=50&sampling=4:2:0' -o photo.jpg
+    curl http://127.0.0.1:8080/metrics
+
+POST /compress takes the image file as the request body and the encode
+options as query parameters (quality, sampling, dct, optimize_huffman,
+progressive, trellis, grayscale=auto/always/never, target_size and timeout in
+seconds). Encodes run in a pool of worker processes fed by a bounded queue:
+when the queue is full the request gets 503 at once. The JPEG is sent back
+with chunked transfer encoding as the worker produces it (one MCU row at a
+time unless the mode needs the whole image). A request that passes its
+deadline is cancelled in its worker and answered with 504, or cut off if the
+JPEG had already started. GET /metrics returns the queue depth, request
+counts, latency histograms and the encoder's stage timings in the Prometheus
+text format.
+"""
+from nativeThreads import limit_native_threads
+
+# 与 batchCompress 相同：每个工作进程只用一个 BLAS/OpenMP 线程（必须在导入 numpy 之前设置）
+limit_native_threads()
+
+import argparse
+import asyncio
+import http
+import io
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import PIL.Image
+
+import jpegEncoder
+from inputImg import SAMPLING_FACTORS, ImageSource
+from instrumentation import Instrumentation
+
+DEFAULT_TIMEOUT = 30.0  # 请求没有指定 timeout 时的期限（秒）
+MAX_TIMEOUT = 300.0
+CANCEL_GRACE = 2.0  # 取消后等待工作进程停下的秒数，超过就结束并重启该进程
+HEADER_TIMEOUT = 10.0  # 读取请求行和请求头的期限
+MAX_BODY_BYTES = 64 * 1024 * 1024
+CHUNK_BYTES = 64 * 1024  # 工作进程每攒够这么多字节就发回一次
+# 提前返回错误（没有读请求体）之后，最多再读掉这么多字节、等这么多秒，再关闭连接
+DISCARD_BYTES = MAX_BODY_BYTES
+DISCARD_TIMEOUT = 2.0
+# 延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+GRAYSCALE_CHOICES = {'auto': None, 'always': True, 'never': False}
+
+
+class RequestError(Exception):
+    """A request that cannot be served, with the HTTP status to answer it with."""
+
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class LatencyHistogram(object):
+    """Counts observations (seconds) in cumulative buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_prometheus(self, name, description):
+        """Returns the lines of the histogram in the Prometheus text exposition format."""
+        lines = ['# HELP {} {}'.format(name, description), '# TYPE {} histogram'.format(name)]
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, self.count))
+        return lines
+
+
+def parse_options(query):
+    """Turns the query parameters of a /compress request into (encode options, timeout in seconds).
+
+    :raises RequestError: (400) for unknown parameters or invalid values.
+    """
+    parameters = dict((name, values[-1]) for name, values in parse_qs(query, keep_blank_values=True).items())
+    options = {}
+    try:
+        options['quality'] = int(parameters.pop('quality', 50))
+        # 与 encode 相同的检查，不在范围内时在排队之前就返回 400
+        jpegEncoder.check_quality(options['quality'])
+        options['sampling'] = parameters.pop('sampling', '4:4:4')
+        if options['sampling'] not in SAMPLING_FACTORS:
+            raise ValueError('sampling must be one of ' + ', '.join(sorted(SAMPLING_FACTORS)))
+        options['dct'] = parameters.pop('dct', 'float')
+        if options['dct'] not in ('float', 'aan'):
+            raise ValueError('dct must be float or aan')
+        for flag in ('optimize_huffman', 'progressive', 'trellis'):
+            value = parameters.pop(flag, 'false').lower()
+            if value not in ('', '1', 'true', '0', 'false'):
+                raise ValueError('{} must be true or false'.format(flag))
+            options[flag] = value in ('', '1', 'true')
+        grayscale = parameters.pop('grayscale', 'auto')
+        if grayscale not in GRAYSCALE_CHOICES:
+            raise ValueError('grayscale must be auto, always or never')
+        options['grayscale'] = GRAYSCALE_CHOICES[grayscale]
+        if 'target_size' in parameters:
+            options['target_size'] = int(parameters.pop('target_size'))
+            if options['target_size'] <= 0:
+                raise ValueError('target_size must be positive')
+        timeout = float(parameters.pop('timeout', DEFAULT_TIMEOUT))
+        if not 0 < timeout <= MAX_TIMEOUT:
+            raise ValueError('timeout must be between 0 and {} seconds'.format(MAX_TIMEOUT))
+    except ValueError as error:
+        raise RequestError(400, str(error))
+    if parameters:
+        raise RequestError(400, 'unknown parameters: ' + ', '.join(sorted(parameters)))
+    if options['progressive'] and 'target_size' in options:
+        raise RequestError(400, 'progressive cannot be combined with target_size')
+    # 整幅编码的模式之外都逐行(MCU)编码，生成一行就能发回一行
+    options['streaming'] = not options['progressive'] and 'target_size' not in options
+    return options, timeout
+
+
+class _ChunkWriter(object):
+    """File-like object of a worker process sending what is written to the server in CHUNK_BYTES pieces."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.connection.send(('data', bytes(self.buffer)))
+            self.buffer = bytearray()
+
+
+def _worker_main(connection, cancel_flag):
+    """Runs in a worker process: encodes the (body, options) jobs received on connection until None.
+
+    Sends ('data', bytes) messages while encoding, then ('done', stats dict
+    and instrumentation), ('cancelled', None) or ('error', message).
+    """
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        body, options = job
+        writer = _ChunkWriter(connection)
+        instrumentation = Instrumentation()
+        try:
+            image = PIL.Image.open(io.BytesIO(body))
+            image.load()
+            stats = jpegEncoder.encode(ImageSource(image, len(body)), writer, cancelled=lambda: cancel_flag.value,
+                                       instrumentation=instrumentation, **options)
+            writer.flush()
+        except jpegEncoder.EncodeCancelled:
+            connection.send(('cancelled', None))
+        except Exception as error:
+            connection.send(('error', '{}: {}'.format(type(error).__name__, error)))
+        else:
+            connection.send(('done', ({'input_size': stats.input_size, 'output_size': stats.output_size,
+                                       'quality': stats.quality, 'seconds': stats.timings['total']},
+                                      instrumentation)))
+
+
+class _Job(object):
+    """A queued or running encode and the messages its worker sent back."""
+
+    def __init__(self, body, options, deadline):
+        self.body = body
+        self.options = options
+        self.deadline = deadline  # loop.time() 时间
+        self.queued_time = time.perf_counter()
+        self.messages = asyncio.Queue()
+        self.cancelled = asyncio.Event()
+        self.slot = None  # 正在编码它的 _WorkerSlot
+
+    def remaining(self):
+        return self.deadline - asyncio.get_running_loop().time()
+
+    def cancel(self):
+        """Asks the worker (if it already started) to stop the encode at its next strip or stage."""
+        if not self.cancelled.is_set():
+            self.cancelled.set()
+            if self.slot is not None:
+                self.slot.cancel_flag.value = 1
+
+
+class _WorkerSlot(object):
+    """One worker process, its pipe and its cancel flag."""
+
+    def __init__(self, context):
+        self.context = context
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.connection, child_connection = self.context.Pipe()
+        self.cancel_flag = self.context.Value('b', 0, lock=False)
+        self.process = self.context.Process(target=_worker_main, args=(child_connection, self.cancel_flag),
+                                            daemon=True)
+        self.process.start()
+        # 子进程退出后父进程这端的 recv 才能读到 EOF
+        child_connection.close()
+
+    def restart(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+        self.start()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(CANCEL_GRACE)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+
+class EncoderPool(object):
+    """A bounded queue of encode jobs served by a fixed number of worker processes."""
+
+    def __init__(self, workers, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # spawn：不在带有事件循环和线程的进程里 fork
+        context = multiprocessing.get_context('spawn')
+        self.slots = [_WorkerSlot(context) for _ in range(workers)]
+        # 阻塞的 send/recv 放到线程里，每个工作进程一个线程
+        self.threads = ThreadPoolExecutor(max_workers=workers)
+        self.busy = 0
+        self.restarts = 0
+        self.queue_seconds = LatencyHistogram()
+        self.encode_seconds = LatencyHistogram()
+        self.instrumentation = Instrumentation()
+        self.tasks = [asyncio.ensure_future(self._serve(slot)) for slot in self.slots]
+
+    def submit(self, body, options, deadline):
+        """Queues a job, returning it (or None when the queue is full)."""
+        job = _Job(body, options, deadline)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return None
+        return job
+
+    def is_full(self):
+        return self.queue.full()
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.threads, slot.stop) for slot in self.slots))
+        self.threads.shutdown()
+
+    async def _serve(self, slot):
+        while True:
+            job = await self.queue.get()
+            if job.cancelled.is_set():
+                # 在队列中就已过期或客户端已放弃
+                job.messages.put_nowait(('cancelled', None))
+                continue
+            self.queue_seconds.observe(time.perf_counter() - job.queued_time)
+            self.busy += 1
+            try:
+                await self._run(slot, job)
+            finally:
+                self.busy -= 1
+                job.slot = None
+
+    async def _run(self, slot, job):
+        loop = asyncio.get_running_loop()
+        slot.cancel_flag.value = 0
+        job.slot = slot
+        start_time = time.perf_counter()
+        try:
+            await loop.run_in_executor(self.threads, slot.connection.send, (job.body, job.options))
+        except OSError:
+            self._restart(slot)
+            job.messages.put_nowait(('error', 'the worker process exited'))
+            return
+        job.body = None
+        cancel_wait = asyncio.ensure_future(job.cancelled.wait())
+        try:
+            while True:
+                receive = loop.run_in_executor(self.threads, slot.connection.recv)
+                if not cancel_wait.done():
+                    await asyncio.wait({receive, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+                if not receive.done():
+                    # 已经取消：等工作进程在下一个条带或阶段停下，太久不停就结束它
+                    await asyncio.wait({receive}, timeout=CANCEL_GRACE)
+                if not receive.done():
+                    # 结束进程后 recv 读到 EOF，再在下面重启
+                    slot.process.kill()
+                    await asyncio.wait({receive})
+                try:
+                    kind, payload = receive.result()
+                except (EOFError, OSError):
+                    self._restart(slot)
+                    job.messages.put_nowait(('cancelled', None) if job.cancelled.is_set()
+                                            else ('error', 'the worker process exited'))
+                    return
+                if kind == 'done':
+                    stats, instrumentation = payload
+                    self.encode_seconds.observe(time.perf_counter() - start_time)
+                    with self.instrumentation.encoding():
+                        self.instrumentation.merge(instrumentation)
+                    payload = stats
+                job.messages.put_nowait((kind, payload))
+                if kind != 'data':
+                    return
+        finally:
+            cancel_wait.cancel()
+
+    def _restart(self, slot):
+        self.restarts += 1
+        slot.restart()
+
+
+class CompressServer(object):
+    """The HTTP front end: parses requests, queues them on an EncoderPool and streams the JPEGs back."""
+
+    def __init__(self, workers, queue_size, max_body_bytes=MAX_BODY_BYTES):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_body_bytes = max_body_bytes
+        self.pool = None
+        self.server = None
+        self.responses = {}  # 状态码 -> 次数
+        self.request_seconds = LatencyHistogram()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.pool = EncoderPool(self.workers, self.queue_size)
+        try:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        except OSError:
+            await self.pool.close()
+            raise
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.pool.close()
+
+    async def _handle_connection(self, reader, writer):
+        start_time = time.perf_counter()
+        status = None
+        try:
+            status = await self._handle_request(reader, writer)
+        except RequestError as error:
+            status = error.status
+            await self._send_text(writer, status, str(error) + '\n')
+            await self._discard_request(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            status = 499  # 客户端在响应完成之前断开
+        finally:
+            if status is not None:
+                self.responses[status] = self.responses.get(status, 0) + 1
+                self.request_seconds.observe(time.perf_counter() - start_time)
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """Serves one request (the connection is closed after it), returning the response status."""
+        loop = asyncio.get_running_loop()
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+            if not request_line:
+                return None
+            method, target, _ = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except (ValueError, asyncio.TimeoutError):
+            raise RequestError(400, 'malformed or incomplete request head')
+
+        url = urlsplit(target)
+        if url.path == '/metrics':
+            if method != 'GET':
+                raise RequestError(405, 'use GET for /metrics')
+            await self._send_text(writer, 200, self.metrics(), 'text/plain; version=0.0.4')
+            return 200
+        if url.path != '/compress':
+            raise RequestError(404, 'no such path: ' + url.path)
+        if method != 'POST':
+            raise RequestError(405, 'POST the image to /compress')
+        options, timeout = parse_options(url.query)
+        deadline = loop.time() + timeout
+        if 'content-length' not in headers:
+            raise RequestError(411, 'the request needs a Content-Length')
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise RequestError(400, 'invalid Content-Length')
+        if length > self.max_body_bytes:
+            raise RequestError(413, 'the image is larger than {} bytes'.format(self.max_body_bytes))
+        if self.pool.is_full():
+            # 队列已满时不等请求体读完就拒绝（请求体之后读掉丢弃）
+            raise RequestError(503, 'the encoder queue is full, retry later')
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            raise RequestError(408, 'timed out reading the image')
+
+        job = self.pool.submit(body, options, deadline)
+        if job is None:
+            raise RequestError(503, 'the encoder queue is full, retry later')
+        del body
+        started = False
+        try:
+            while True:
+                try:
+                    kind, payload = await asyncio.wait_for(job.messages.get(), max(job.remaining(), 0))
+                except asyncio.TimeoutError:
+                    kind, payload = 'cancelled', None
+                if kind == 'data':
+                    if not started:
+                        started = True
+                        writer.write(self._head(200, [('Content-Type', 'image/jpeg'),
+                                                      ('Transfer-Encoding', 'chunked')]))
+                    writer.write('{:X}\r\n'.format(len(payload)).encode('ascii') + payload + b'\r\n')
+                    await writer.drain()
+                    continue
+                if kind == 'done':
+                    writer.write(b'0\r\n\r\n')
+                    await writer.drain()
+                    return 200
+                status = 504 if kind == 'cancelled' else 500
+                if started:
+                    # 已经发出了部分 JPEG：不写结束块，直接断开，客户端能看出响应不完整
+                    writer.transport.abort()
+                    return status
+                if kind == 'cancelled':
+                    raise RequestError(504, 'the encode did not finish within {} seconds'.format(timeout))
+                # 多数是无法识别的图像，算作请求错误
+                raise RequestError(400, 'cannot encode the image: ' + payload)
+        finally:
+            # 超时、出错或客户端断开时让工作进程停下（已结束的任务没有影响）
+            job.cancel()
+
+    def metrics(self):
+        """Returns the server and encoder metrics in the Prometheus text exposition format."""
+        pool = self.pool
+        lines = ['# HELP jpeg_server_queue_depth Encode jobs waiting for a worker.',
+                 '# TYPE jpeg_server_queue_depth gauge',
+                 'jpeg_server_queue_depth {}'.format(pool.queue.qsize()),
+                 '# HELP jpeg_server_queue_capacity Size of the encode queue.',
+                 '# TYPE jpeg_server_queue_capacity gauge',
+                 'jpeg_server_queue_capacity {}'.format(pool.queue.maxsize),
+                 '# HELP jpeg_server_busy_workers Worker processes encoding right now.',
+                 '# TYPE jpeg_server_busy_workers gauge',
+                 'jpeg_server_busy_workers {}'.format(pool.busy),
+                 '# HELP jpeg_server_workers Worker processes.',
+                 '# TYPE jpeg_server_workers gauge',
+                 'jpeg_server_workers {}'.format(len(pool.slots)),
+                 '# HELP jpeg_server_worker_restarts_total Workers killed and restarted (stuck after a cancel).',
+                 '# TYPE jpeg_server_worker_restarts_total counter',
+                 'jpeg_server_worker_restarts_total {}'.format(pool.restarts),
+                 '# HELP jpeg_server_responses_total Responses by HTTP status (499: client went away).',
+                 '# TYPE jpeg_server_responses_total counter']
+        for status, count in sorted(self.responses.items()):
+            lines.append('jpeg_server_responses_total{{status="{}"}} {}'.format(status, count))
+        lines += self.request_seconds.to_prometheus('jpeg_server_request_seconds',
+                                                    'Time from accepting a connection to the end of its response.')
+        lines += pool.queue_seconds.to_prometheus('jpeg_server_queue_wait_seconds',
+                                                  'Time encode jobs waited in the queue.')
+        lines += pool.encode_seconds.to_prometheus('jpeg_server_encode_seconds',
+                                                   'Time a worker spent on each finished encode.')
+        return '\n'.join(lines) + '\n' + pool.instrumentation.to_prometheus()
+
+    @staticmethod
+    def _head(status, headers):
+        lines = ['HTTP/1.1 {} {}'.format(status, http.HTTPStatus(status).phrase)]
+        lines += ['{}: {}'.format(name, value) for name, value in headers + [('Connection', 'close')]]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    @staticmethod
+    async def _discard_request(reader, writer):
+        """Half-closes the connection after an error response and reads what is left of the request.
+
+        Closing a socket with unread data resets the connection, and a client
+        still sending its body would then get the reset instead of the response.
+        """
+        # 先发 FIN 表示响应已经结束，再读掉（有上限、有期限）客户端还在发送的请求体，直到它关闭连接
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+            remaining = DISCARD_BYTES
+            deadline = asyncio.get_running_loop().time() + DISCARD_TIMEOUT
+            while remaining > 0:
+                data = await asyncio.wait_for(reader.read(min(remaining, CHUNK_BYTES)),
+                                              deadline - asyncio.get_running_loop().time())
+                if not data:
+                    break
+                remaining -= len(data)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    async def _send_text(self, writer, status, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        headers = [('Content-Type', content_type), ('Content-Length', len(body))]
+        if status == 503:
+            headers.append(('Retry-After', 1))
+        writer.write(self._head(status, headers) + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def serve(host, port, workers, queue_size, max_body_bytes=MAX_BODY_BYTES):
+    """Runs a CompressServer until cancelled or sent SIGTERM."""
+    server = CompressServer(workers, queue_size, max_body_bytes)
+    await server.start(host, port)
+    print('压缩服务：http://{}:{}/compress（{} 个进程，队列长度 {}）'.format(host, port, workers, queue_size))
+    stopping = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    except (NotImplementedError, AttributeError):
+        pass  # Windows 上没有 add_signal_handler / SIGTERM，用 Ctrl+C 结束
+    try:
+        await stopping.wait()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves the JPEG encoder over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--queue', type=int, help='jobs that may wait for a worker (default: 2 * workers)')
+    parser.add_argument('--max-body-mb', type=float, default=MAX_BODY_BYTES / (1024 * 1024))
+    args = parser.parse_args(argv)
+    workers = max(args.workers, 1)
+    queue_size = args.queue if args.queue is not None else 2 * workers
+    try:
+        asyncio.run(serve(args.host, args.port, workers, max(queue_size, 1), int(args.max_body_mb * 1024 * 1024)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,12 @@
-"""Defines functions to generate huffman codes given a list of symbols.
-
-These functions aren't actually used by the jpeg-encoder, but serve as a decent
-example of huffman coding. The reason they aren't used is because JPEG
-adds some rules on the huffman codes generated and I didn't have time to sort
-out how that changes code generation (16 bit max code length, no code is all
-1's). Also defined here are some of the default huffman tables that the JPEG
-standard recommends if generation isn't possible (these are used in the actual
-jpeg-encoder entrypoint).
+"""Defines functions to generate huffman codes given symbol frequencies.
+
+The codes are generated following JPEG's rules (Annex K.2 of the standard):
+code lengths are limited to 16 bits and no code is all 1's. They are used by
+the jpeg-encoder when optimized huffman tables are requested. Also defined
+here are some of the default huffman tables that the JPEG standard recommends
+(these are used by the jpeg-encoder by default).
 """
+import numpy
 
 # Define the standard JPEG huffman tables (instead of using my huffman
 # methods since JPEG has specific requirements about the codes generated)
@@ -186,3 +185,105 @@ JPEG_HUFFMAN_AC_LUM = {
     0xF9: '1111111111111101',
     0xFA: '1111111111111110'
 }
+
+
+def generate_code_lengths(frequencies):
+    """Returns the BITS list (number of codes of each length 1-16) and HUFFVAL list.
+
+    :param frequencies: how often each of the 256 symbols occurs.
+    """
+    # 多加一个频率为 1 的保留符号 256，保证不会有全 1 的码字
+    freq = [int(count) for count in frequencies] + [1]
+    codesize = [0] * 257
+    others = [-1] * 257
+    while True:
+        # 找到频率最小的两个符号（频率相同时取较大的符号）
+        c1 = -1
+        v = None
+        for index in range(257):
+            if freq[index] and (v is None or freq[index] <= v):
+                v = freq[index]
+                c1 = index
+        c2 = -1
+        v = None
+        for index in range(257):
+            if freq[index] and index != c1 and (v is None or freq[index] <= v):
+                v = freq[index]
+                c2 = index
+        if c2 < 0:
+            break
+        # 合并两棵子树，两边所有符号的码长各加一
+        freq[c1] += freq[c2]
+        freq[c2] = 0
+        codesize[c1] += 1
+        while others[c1] >= 0:
+            c1 = others[c1]
+            codesize[c1] += 1
+        others[c1] = c2
+        codesize[c2] += 1
+        while others[c2] >= 0:
+            c2 = others[c2]
+            codesize[c2] += 1
+
+    bits = [0] * 33
+    for size in codesize:
+        if size:
+            bits[size] += 1
+
+    # 把超过 16 位的码长调整到 16 位以内 (Annex K.3)
+    for length in range(32, 16, -1):
+        while bits[length] > 0:
+            shorter = length - 2
+            while bits[shorter] == 0:
+                shorter -= 1
+            bits[length] -= 2
+            bits[length - 1] += 1
+            bits[shorter + 1] += 2
+            bits[shorter] -= 1
+
+    # 去掉保留符号（它一定是最长码字中的一个）
+    length = 16
+    while bits[length] == 0:
+        length -= 1
+    bits[length] -= 1
+
+    huffval = []
+    for size in range(1, 33):
+        for symbol in range(256):
+            if codesize[symbol] == size:
+                huffval.append(symbol)
+    return bits[1:17], huffval
+
+
+def generate_huffman_table(frequencies):
+    """Generates an optimal JPEG huffman table {symbol: code string} from symbol frequencies."""
+    bits, huffval = generate_code_lengths(frequencies)
+    # 规范哈夫曼码：同一长度的码字依次加一，长度增加时左移一位 (Annex C)
+    table = {}
+    code = 0
+    symbols = iter(huffval)
+    for length, count in enumerate(bits, start=1):
+        for _ in range(count):
+            table[next(symbols)] = format(code, '0{}b'.format(length))
+            code += 1
+        code <<= 1
+    return table
+
+
+def compile_huffman_table(huffman_table):
+    """Compiles a {symbol: code string} table into (codes, lengths) lookup arrays.
+
+    Both arrays are indexed by the symbol (0-255); unused symbols have length 0.
+    """
+    codes = numpy.zeros(256, dtype=numpy.uint32)
+    lengths = numpy.zeros(256, dtype=numpy.uint8)
+    for symbol, code in huffman_table.items():
+        codes[symbol] = int(code, 2)
+        lengths[symbol] = len(code)
+    return codes, lengths
+
+
+# 编译好的查找表，熵编码时直接用符号作下标
+JPEG_HUFFMAN_DC_LUM_LOOKUP = compile_huffman_table(JPEG_HUFFMAN_DC_LUM)
+JPEG_HUFFMAN_DC_CHROM_LOOKUP = compile_huffman_table(JPEG_HUFFMAN_DC_CHROM)
+JPEG_HUFFMAN_AC_LUM_LOOKUP = compile_huffman_table(JPEG_HUFFMAN_AC_LUM)
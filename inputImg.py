@@ -1,42 +1,80 @@
 """Handles reading in images and preparing them for compression."""
+import os
+import struct
+
 import PIL.Image
 import numpy
 
+# 亮度通道的（水平，垂直）采样系数，色度通道固定为 1x1
+SAMPLING_FACTORS = {'4:4:4': (1, 1), '4:2:2': (2, 1), '4:2:0': (2, 2)}
+# JFIF（全范围 BT.601）的 RGB -> YCbCr 系数；Cb、Cr 的 +128 与电平平移的 -128 正好抵消
+RGB_TO_YCBCR = numpy.array([[0.299, 0.587, 0.114],
+                            [-0.168736, -0.331264, 0.5],
+                            [0.5, -0.418688, -0.081312]], dtype=numpy.float32)
+# 这些模式的 PIL 图像只编码亮度通道
+GRAYSCALE_MODES = ('1', 'L', 'LA', 'La')
+# 色度与中性值（平移后为 0）相差不超过这么多时，认为图像实际上是灰度图
+FLAT_CHROMA_TOLERANCE = 1.0
+
 
-def create_matrices_pixel_sequence(pixels, width, height):
-    """Creates a list of 8x8 matrices from the pixel sequence.
-    :param : The sequence of pixels representing the image/colorband.
-    :type : list.
+def create_matrices_pixel_sequence(pixels, width, height, dtype=numpy.float64):
+    """Creates a stack of 8x8 matrices from the pixel sequence.
+    :param pixels: The pixels representing the image/colorband (2-D array or flat sequence).
+    :type pixels: numpy.ndarray.
     :param width: the width of the original image (must be a multiple of 8).
-    :type n_point: int.
+    :type width: int.
     :param height: the height of the original image (must be a multiple of 8).
-    :type n_point: int.
-    :returns: list -- A list of the numpy.array matrices (from left to right).
+    :type height: int.
+    :param dtype: the dtype of the returned blocks.
+    :returns: numpy.ndarray -- An (N, 8, 8) stack of the blocks (from left to right, top to bottom).
     """
-    if width % 8 != 0 or height % 8 != 0 or len(pixels) != width * height:
+    pixels = numpy.asarray(pixels)
+    if width % 8 != 0 or height % 8 != 0 or pixels.size != width * height:
         # Not at all the best way to handle this
         assert width % 8 == 0
         assert height % 8 == 0
-        assert len(pixels) == width * height
-    matrices = []
-    start_of_row = 0
-    end_of_row = start_of_row + width
-
-    # Jump down 8 rows once we get to the end of a row
-    while start_of_row < width * height:
-        # Create matrices across a row
-        current = start_of_row
-        while current < end_of_row:
-            matrix = numpy.empty((8, 8))
-            for column in range(current, current + 8):
-                for row in range(8):
-                    matrix[row][column - current] = pixels[column + row * width]
-            matrices.append(matrix)
-            current += 8
-        start_of_row += 8 * width  # Jump down 8 rows
-        end_of_row = start_of_row + width
-
-    return matrices
+        assert pixels.size == width * height
+    # 将 (height, width) 的平面看作 (块行, 8, 块列, 8)，交换中间两轴后即是按行排列的 8x8 块，
+    # 只在最后转换类型时拷贝一次
+    blocks = pixels.reshape(height // 8, 8, width // 8, 8).swapaxes(1, 2)
+    return blocks.astype(dtype, order='C').reshape(-1, 8, 8)
+
+
+def create_mcu_matrices(pixels, h_factor=1, v_factor=1, dtype=numpy.float64):
+    """Creates a stack of the 8x8 matrices of a band, grouped by MCU.
+
+    :param pixels: the 2-D (height, width) pixels of the band.
+    :param h_factor: the number of blocks per MCU horizontally.
+    :param v_factor: the number of blocks per MCU vertically.
+    :param dtype: the dtype of the returned blocks.
+    :returns: numpy.ndarray -- An (M, v_factor * h_factor, 8, 8) stack, the MCUs
+        from left to right, top to bottom and the blocks inside each MCU in the same order.
+    """
+    pixels = numpy.asarray(pixels)
+    height, width = pixels.shape
+    assert width % (8 * h_factor) == 0
+    assert height % (8 * v_factor) == 0
+    rows = height // (8 * v_factor)
+    columns = width // (8 * h_factor)
+    blocks = pixels.reshape(rows, v_factor, 8, columns, h_factor, 8).transpose(0, 3, 1, 4, 2, 5)
+    return blocks.astype(dtype, order='C').reshape(rows * columns, v_factor * h_factor, 8, 8)
+
+
+def downsample_band(pixels, h_factor, v_factor):
+    """Averages every h_factor x v_factor group of pixels of a 2-D band (chroma subsampling)."""
+    pixels = numpy.asarray(pixels)
+    if h_factor == 1 and v_factor == 1:
+        return pixels
+    height, width = pixels.shape
+    groups = pixels.reshape(height // v_factor, v_factor, width // h_factor, h_factor)
+    # 逐个累加每组中相同位置的像素，比 mean(axis=(1, 3)) 快得多，结果相同
+    total = groups[:, 0, :, 0].astype(numpy.promote_types(pixels.dtype, numpy.float32))
+    for row in range(v_factor):
+        for column in range(h_factor):
+            if row or column:
+                total += groups[:, row, :, column]
+    total *= 1.0 / (h_factor * v_factor)
+    return total
 
 
 def get_image(path):
@@ -62,5 +100,227 @@ def get_ycbcr_bands(image):
 
 
 def get_pixels(band):
-    """Returns a list of pixels given a band."""
-    return list(band.getdata())
+    """Returns the pixels of a band as a 2-D (height, width) numpy.array."""
+    return numpy.asarray(band)
+
+
+def rgb_to_ycbcr_planes(pixels, components=3):
+    """Converts (height, width, 3) uint8 RGB pixels to level-shifted Y, Cb, Cr planes.
+
+    :param components: 1 to compute only the Y plane.
+    :returns: numpy.ndarray -- a (components, height, width) float32 array,
+        one contiguous plane per component, centered around 0 (-128 to 127)
+        and not rounded, ready for create_mcu_matrices.
+    """
+    pixels = numpy.asarray(pixels)
+    height, width = pixels.shape[:2]
+    planes = numpy.empty((components, height * width), dtype=numpy.float32)
+    # (3, 3) x (3, N) 的一次矩阵乘法同时完成颜色转换、类型转换和按平面分离；Y 再减去 128
+    numpy.matmul(RGB_TO_YCBCR[:components], pixels.reshape(-1, 3).T, out=planes, dtype=numpy.float32)
+    planes[0] -= 128
+    return planes.reshape(components, height, width)
+
+
+def level_shift(pixels):
+    """Returns a uint8 plane as a contiguous float32 plane centered around 0."""
+    return numpy.subtract(pixels, 128, dtype=numpy.float32)
+
+
+def gray_planes(pixels, components=3):
+    """Returns the level-shifted planes of (height, width) grayscale pixels (Cb and Cr are 0)."""
+    height, width = pixels.shape
+    planes = numpy.zeros((components, height, width), dtype=numpy.float32)
+    numpy.subtract(pixels, 128, out=planes[0], dtype=numpy.float32)
+    return planes
+
+
+def get_image_planes(image, components=3):
+    """Returns the level-shifted (components, height, width) float32 Y, Cb, Cr planes of a PIL image."""
+    if image.mode in GRAYSCALE_MODES:
+        if image.mode != 'L':
+            image = image.convert(mode='L')
+        return gray_planes(numpy.asarray(image), components)
+    if image.mode == 'YCbCr':
+        return numpy.stack([level_shift(get_pixels(band)) for band in image.split()[:components]])
+    if image.mode != 'RGB':
+        image = image.convert(mode='RGB')
+    return rgb_to_ycbcr_planes(numpy.asarray(image), components)
+
+
+def chroma_is_flat(planes, tolerance=FLAT_CHROMA_TOLERANCE):
+    """Whether the level-shifted Cb and Cr planes all stay within tolerance of neutral (0)."""
+    return all(plane.min() >= -tolerance and plane.max() <= tolerance for plane in planes[1:])
+
+
+def pad_planes(planes, width, height, h_factor=1, v_factor=1):
+    """Pads planes to width x height by repeating their last row and column (chroma planes may be subsampled).
+
+    width and height are multiples of the MCU size; planes that already have
+    the size are returned as they are.
+    """
+    lum = planes[0]
+    padded = []
+    for plane in planes:
+        rows, columns = (height, width) if plane.shape == lum.shape else (height // v_factor, width // h_factor)
+        if plane.shape != (rows, columns):
+            # 与 libjpeg 相同，用边缘像素补齐不足一个 MCU 的部分，解码时再按 SOF 中的宽高裁掉
+            plane = numpy.pad(plane, ((0, rows - plane.shape[0]), (0, columns - plane.shape[1])), mode='edge')
+        padded.append(plane)
+    return padded
+
+
+class ImageSource(object):
+    """Reads the Y, Cb, Cr planes of a PIL image, a strip of rows at a time."""
+
+    def __init__(self, image, size=None):
+        self.image = image
+        self.width, self.height = image.size
+        # 输入的字节数（文件大小或像素数据大小），用于统计压缩率
+        self.size = size
+        # 源本身是灰度图时只编码一个通道
+        self.grayscale = image.mode in GRAYSCALE_MODES
+
+    def read_planes(self, top, bottom, width, h_factor=1, v_factor=1, components=3):
+        """Returns the (Y, Cb, Cr) planes of rows top to bottom, columns 0 to width.
+
+        The planes are 2-D float32 arrays already level shifted to be
+        centered around 0; with components=1 only the Y plane is returned.
+        Sources that store the chroma subsampled by exactly h_factor x
+        v_factor may return the Cb and Cr planes at that size (rounded up)
+        instead; the encoder then uses them as they are.
+        """
+        return get_image_planes(self.image.crop((0, top, width, bottom)), components)
+
+
+class ArraySource(ImageSource):
+    """Reads the Y, Cb, Cr planes of an (height, width[, channels]) uint8 pixel array.
+
+    The array (anything supporting the buffer protocol) is not copied, only
+    the strips being read are.
+    """
+
+    def __init__(self, pixels):
+        self.pixels = numpy.asarray(pixels)
+        self.height, self.width = self.pixels.shape[:2]
+        self.size = self.pixels.nbytes
+        self.grayscale = self.pixels.ndim == 2 or self.pixels.shape[2] <= 2
+
+    def read_planes(self, top, bottom, width, h_factor=1, v_factor=1, components=3):
+        strip = self.pixels[top:bottom, :width]
+        if strip.ndim == 3 and strip.shape[2] <= 2:
+            strip = strip[:, :, 0]  # Grayscale (and alpha)
+        if strip.ndim == 2:
+            return gray_planes(strip, components)
+        return rgb_to_ycbcr_planes(strip[:, :, :3], components)  # Drop the alpha channel
+
+
+def read_bmp_layout(path):
+    """Reads the headers of an uncompressed 24 or 32 bit BMP file.
+
+    :returns: (pixel data offset, width, height, bytes per pixel, bottom-up)
+        or None if the file is not a BMP of that kind (palettes, RLE and
+        unusual bit masks are left to PIL).
+    """
+    with open(path, 'rb') as bmp_file:
+        header = bmp_file.read(70)
+    if len(header) < 54 or header[:2] != b'BM':
+        return None
+    offset, = struct.unpack_from('<I', header, 10)
+    info_size, width, height, planes, bit_count, compression = struct.unpack_from('<IiiHHI', header, 14)
+    if info_size < 40 or planes != 1 or bit_count not in (24, 32) or width <= 0 or height == 0:
+        return None
+    if compression == 3:  # BI_BITFIELDS，只接受标准的 BGR(A) 掩码
+        # 掩码紧跟在 40 字节的 BITMAPINFOHEADER 之后（V4/V5 头中也在同一位置）
+        if bit_count != 32 or len(header) < 66 or struct.unpack_from('<III', header, 54) != (0xFF0000, 0xFF00, 0xFF):
+            return None
+    elif compression != 0:  # 不是 BI_RGB
+        return None
+    return offset, width, abs(height), bit_count // 8, height > 0
+
+
+class BmpSource(ArraySource):
+    """Reads an uncompressed 24 or 32 bit BMP file through a numpy.memmap.
+
+    Only the strips being read are loaded (and copied for the color
+    conversion), so with streaming the file can be larger than the memory.
+    """
+
+    def __init__(self, path, layout=None):
+        offset, width, height, pixel_bytes, bottom_up = layout or read_bmp_layout(path)
+        # 每行按 4 字节对齐
+        stride = (width * pixel_bytes + 3) & ~3
+        rows = numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=offset, shape=(height, stride))
+        if bottom_up:
+            rows = rows[::-1]  # BMP 默认从最下面一行开始存储
+        # 按 BGR(A) 存储，反转前三个字节即为 RGB，都只是视图，不拷贝
+        self.pixels = rows[:, :width * pixel_bytes].reshape(height, width, pixel_bytes)[:, :, 2::-1]
+        self.height, self.width = height, width
+        self.size = os.path.getsize(path)
+        self.grayscale = False
+
+
+class RawYCbCrSource(ImageSource):
+    """Reads planar 8 bit Y, Cb, Cr frames from a raw file through a numpy.memmap.
+
+    layout is 'i420' (Cb and Cr subsampled 2x2, like YUV420p) or 'yuv444'.
+    The samples are only level shifted, without any color conversion, and for
+    'i420' encoded with 4:2:0 sampling the chroma is not averaged again.
+    frame picks a frame of a file holding several consecutive ones.
+    """
+
+    LAYOUTS = {'i420': (2, 2), 'yuv444': (1, 1)}
+
+    def __init__(self, path, width, height, layout='i420', frame=0):
+        if layout not in self.LAYOUTS:
+            raise ValueError('unknown raw layout {!r} (expected one of {})'.format(
+                layout, ', '.join(sorted(self.LAYOUTS))))
+        self.h_factor, self.v_factor = self.LAYOUTS[layout]
+        chroma_width = -(-width // self.h_factor)
+        chroma_height = -(-height // self.v_factor)
+        frame_size = width * height + 2 * chroma_width * chroma_height
+        file_size = os.path.getsize(path)
+        if file_size < (frame + 1) * frame_size:
+            raise ValueError('{} holds {} bytes, too few for frame {} of {}x{} {}'.format(
+                path, file_size, frame, width, height, layout))
+        planes = numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=frame * frame_size, shape=(frame_size,))
+        chroma_size = chroma_width * chroma_height
+        self.y = planes[:width * height].reshape(height, width)
+        self.cb = planes[width * height:width * height + chroma_size].reshape(chroma_height, chroma_width)
+        self.cr = planes[width * height + chroma_size:].reshape(chroma_height, chroma_width)
+        self.width, self.height = width, height
+        self.size = frame_size  # 只统计编码的这一帧
+        self.grayscale = False
+
+    def read_planes(self, top, bottom, width, h_factor=1, v_factor=1, components=3):
+        lum = level_shift(self.y[top:bottom, :width])
+        if components == 1:
+            return [lum]
+        if (h_factor, v_factor) == (self.h_factor, self.v_factor):
+            # 与编码的采样方式相同，直接交出原始的色度平面
+            chroma = slice(top // v_factor, -(-bottom // v_factor)), slice(0, -(-width // h_factor))
+            return [lum, level_shift(self.cb[chroma]), level_shift(self.cr[chroma])]
+        # 否则先把色度还原到全分辨率（重复采样点），由编码器按需要的方式下采样
+        chroma = slice(top // self.v_factor, -(-bottom // self.v_factor)), slice(0, -(-width // self.h_factor))
+        planes = [lum]
+        for band in (self.cb, self.cr):
+            full = numpy.repeat(numpy.repeat(band[chroma], self.v_factor, axis=0), self.h_factor, axis=1)
+            offset = top % self.v_factor
+            planes.append(level_shift(full[offset:offset + bottom - top, :width]))
+        return planes
+
+
+def open_source(source):
+    """Wraps a path, a PIL Image or a pixel array in a source for the encoder (sources are returned as is).
+
+    Uncompressed BMP files are memory mapped instead of decoded by PIL.
+    """
+    if isinstance(source, ImageSource):
+        return source
+    if isinstance(source, PIL.Image.Image):
+        return ImageSource(source)
+    if isinstance(source, (str, bytes)) or hasattr(source, '__fspath__'):
+        layout = read_bmp_layout(source)
+        if layout is not None:
+            return BmpSource(source, layout)
+        return ImageSource(get_image(source), os.path.getsize(source))
+    return ArraySource(source)
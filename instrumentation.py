@@ -0,0 +1,210 @@
+"""Records where the encoder spends its time, stage by stage.
+
+Pass an Instrumentation to jpegEncoder.encode and every stage (read, blocks,
+dct, quantize, symbols, huffman_tables, entropy, container) adds its
+duration, the 8x8 blocks and bytes it handled and, with trace_memory, the peak
+of the memory traced by tracemalloc while it ran. The records add up over
+encodes, so one Instrumentation can watch a whole service, and they can be
+exported as a dict, JSON or Prometheus text.
+
+tracemalloc traces the whole process. When traced stages overlap (encodes in
+several threads), each peak also counts the memory the others allocate in
+the meantime, so it is an upper bound for that stage.
+
+Without one, encode uses NO_INSTRUMENTATION, whose hooks do nothing.
+"""
+import contextlib
+import json
+import threading
+import time
+import tracemalloc
+
+# tracemalloc 是整个进程共用的：同时进行的编码共用一次跟踪（最后一个结束时才停止），
+# 只有没有别的阶段在跟踪内存时才重置峰值，不会把别的阶段已经记下的峰值清掉
+_memory_lock = threading.Lock()
+_memory_state = {'encodes': 0, 'started': False, 'stages': 0}
+
+
+class StageRecord(object):
+    """The totals of one stage: calls, seconds, blocks, bytes and the largest memory peak."""
+
+    __slots__ = ('calls', 'seconds', 'blocks', 'bytes', 'peak_memory')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.blocks = 0
+        self.bytes = 0
+        self.peak_memory = None  # 没有跟踪内存时为 None
+
+    def to_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'blocks': self.blocks, 'bytes': self.bytes,
+                'peak_memory_bytes': self.peak_memory}
+
+
+class _StageTimer(object):
+    """Context manager timing one run of a stage; set blocks/bytes on it if they are only known at the end."""
+
+    __slots__ = ('instrumentation', 'name', 'blocks', 'bytes', 'start', 'start_memory')
+
+    def __init__(self, instrumentation, name, blocks, nbytes):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.blocks = blocks
+        self.bytes = nbytes
+
+    def __enter__(self):
+        if self.instrumentation.trace_memory:
+            # 记录相对于开始时的增量；没有别的阶段在跟踪时才重置峰值
+            with _memory_lock:
+                if not _memory_state['stages']:
+                    tracemalloc.reset_peak()
+                _memory_state['stages'] += 1
+                self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        peak_memory = None
+        if self.instrumentation.trace_memory:
+            with _memory_lock:
+                peak_memory = tracemalloc.get_traced_memory()[1] - self.start_memory
+                _memory_state['stages'] -= 1
+        self.instrumentation.add(self.name, seconds, self.blocks, self.bytes, peak_memory)
+        return False
+
+
+class Instrumentation(object):
+    """Collects StageRecords for the stages of any number of encodes (thread-safe, see the memory note above)."""
+
+    def __init__(self, trace_memory=False, parent=None):
+        """:param parent: an optional Instrumentation that every measurement is also added to."""
+        self.trace_memory = trace_memory
+        self.parent = parent
+        self.encodes = 0
+        self.stages = {}  # 阶段名 -> StageRecord，按首次出现的顺序
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # 要传给编码重启间隔的子进程，锁不能被 pickle；parent 留在本进程
+        return {'trace_memory': self.trace_memory, 'encodes': self.encodes, 'stages': self.stages}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parent = None
+        self._lock = threading.Lock()
+
+    def stage(self, name, blocks=0, nbytes=0):
+        """Returns a context manager that adds one run of the named stage."""
+        return _StageTimer(self, name, blocks, nbytes)
+
+    @contextlib.contextmanager
+    def encoding(self):
+        """Wraps a whole encode: counts it and runs tracemalloc during it if trace_memory is set."""
+        if self.trace_memory:
+            with _memory_lock:
+                if not _memory_state['encodes'] and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _memory_state['started'] = True
+                _memory_state['encodes'] += 1
+        try:
+            yield self
+        finally:
+            if self.trace_memory:
+                with _memory_lock:
+                    _memory_state['encodes'] -= 1
+                    if not _memory_state['encodes'] and _memory_state['started']:
+                        tracemalloc.stop()
+                        _memory_state['started'] = False
+            with self._lock:
+                self.encodes += 1
+
+    def add(self, name, seconds, blocks=0, nbytes=0, peak_memory=None, calls=1):
+        """Adds a measurement to the named stage."""
+        with self._lock:
+            record = self.stages.get(name)
+            if record is None:
+                record = self.stages[name] = StageRecord()
+            record.calls += calls
+            record.seconds += seconds
+            record.blocks += blocks
+            record.bytes += nbytes
+            if peak_memory is not None and (record.peak_memory is None or peak_memory > record.peak_memory):
+                record.peak_memory = peak_memory
+        if self.parent is not None:
+            self.parent.add(name, seconds, blocks, nbytes, peak_memory, calls)
+
+    def fork(self):
+        """Returns an empty Instrumentation with the same settings, for work done in another process."""
+        return Instrumentation(self.trace_memory)
+
+    def merge(self, other):
+        """Adds the stage records of a fork() (the encode count is not added, it is the same encode)."""
+        for name, record in other.stages.items():
+            self.add(name, record.seconds, record.blocks, record.bytes, record.peak_memory, record.calls)
+
+    def to_dict(self):
+        with self._lock:
+            return {'encodes': self.encodes,
+                    'stages': dict((name, record.to_dict()) for name, record in self.stages.items())}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='jpeg_encoder'):
+        """Returns the records in the Prometheus text exposition format."""
+        snapshot = self.to_dict()
+        lines = ['# HELP {}_encodes_total Encodes recorded.'.format(prefix),
+                 '# TYPE {}_encodes_total counter'.format(prefix),
+                 '{}_encodes_total {}'.format(prefix, snapshot['encodes'])]
+        metrics = [('stage_calls_total', 'counter', 'calls', 'Runs of each encoder stage.'),
+                   ('stage_seconds_total', 'counter', 'seconds', 'Time spent in each encoder stage.'),
+                   ('stage_blocks_total', 'counter', 'blocks', '8x8 blocks handled by each encoder stage.'),
+                   ('stage_bytes_total', 'counter', 'bytes', 'Bytes handled by each encoder stage.'),
+                   ('stage_peak_memory_bytes', 'gauge', 'peak_memory_bytes',
+                    'Largest tracemalloc peak seen in each encoder stage.')]
+        for metric, metric_type, field, description in metrics:
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, description))
+            lines.append('# TYPE {}_{} {}'.format(prefix, metric, metric_type))
+            for name, record in snapshot['stages'].items():
+                if record[field] is not None:
+                    lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, metric, name, record[field]))
+        return '\n'.join(lines) + '\n'
+
+
+class _NullStageTimer(object):
+    """Shared do-nothing stand-in for _StageTimer and encoding()."""
+
+    __slots__ = ('blocks', 'bytes')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullInstrumentation(object):
+    """Instrumentation whose hooks do nothing, used when no listener is attached."""
+
+    trace_memory = False
+    _timer = _NullStageTimer()
+
+    def stage(self, name, blocks=0, nbytes=0):
+        return self._timer
+
+    def encoding(self):
+        return self._timer
+
+    def fork(self):
+        return self
+
+    def merge(self, other):
+        pass
+
+    def add(self, name, seconds, blocks=0, nbytes=0, peak_memory=None, calls=1):
+        pass
+
+
+NO_INSTRUMENTATION = _NullInstrumentation()
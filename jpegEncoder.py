@@ -0,0 +1,850 @@
+"""Implements the JPEG encoder entrypoint, independent of the GUI.
+
+encode() accepts a path, a PIL Image or a pixel array and writes the JPEG to a
+file-like object (or returns its bytes), reporting what it did in an
+EncodeStats object. Nothing here depends on PyQt5, so it can be used by
+scripts and servers as well as by the GUI thread in processImg.
+"""
+import collections
+import functools
+import io
+import numbers
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from compressAlgorithm import L_QUANTIZATION_TABLE, C_QUANTIZATION_TABLE
+from compressAlgorithm import scale_quant_tables, quantization_reciprocals, trellis_quantize_component
+from compressAlgorithm import take_aan_dct_of_component, aan_quantization_table
+from compressAlgorithm import count_class_frequencies, count_scan_bits, EntropyWriter
+from huffmanTables import JPEG_HUFFMAN_DC_LUM, JPEG_HUFFMAN_AC_LUM, JPEG_HUFFMAN_AC_LUM_LOOKUP
+from huffmanTables import compile_huffman_table, generate_huffman_table
+from instrumentation import Instrumentation, NO_INSTRUMENTATION
+from kernelBackends import get_kernel
+from progressiveScans import COLOR_SCAN_SCRIPT, GRAYSCALE_SCAN_SCRIPT, RAW_BITS, dc_first_scan, dc_refine_scan
+from progressiveScans import ac_scan, count_scan_frequencies, encode_scan_items
+from inputImg import SAMPLING_FACTORS, open_source, create_mcu_matrices, downsample_band, chroma_is_flat, pad_planes
+from utils import ZIGZAG_INDEX, get_huffman_table_bytes, map_in_order
+
+PLAN_CACHE_SIZE = 64  # get_encode_plan 最多缓存的 EncodePlan 个数
+# 质量因子的取值范围（值越大量化表越大，文件越小）
+MIN_QUALITY = 0
+MAX_QUALITY = 100
+
+
+def check_quality(quality):
+    """Raises ValueError unless quality is an integer from MIN_QUALITY to MAX_QUALITY."""
+    if isinstance(quality, bool) or not isinstance(quality, numbers.Integral) or \
+            not MIN_QUALITY <= quality <= MAX_QUALITY:
+        raise ValueError('quality must be an integer from {} to {}, not {!r}'.format(MIN_QUALITY, MAX_QUALITY,
+                                                                                    quality))
+
+
+class EncodeCancelled(Exception):
+    """Raised by encode() when its cancelled callable returns True."""
+
+
+class EncodeStats(object):
+    """What an encode did: sizes in bytes, dimensions in pixels and timings in seconds."""
+
+    def __init__(self):
+        self.input_size = None  # 输入文件（或像素数据）的大小，未知时为 None
+        self.output_size = 0
+        self.original_width = 0
+        self.original_height = 0
+        self.width = 0  # 编码的宽高（写入 SOF，不足一个 MCU 的部分用边缘像素补齐）
+        self.height = 0
+        self.quality = None  # 使用的质量因子（target_size 模式下为搜索到的值）
+        self.grayscale = False  # 是否只编码了亮度通道（单通道 JPEG）
+        self.timings = {}  # 阶段名（见 instrumentation）-> 秒数，以及整个编码的 'total'
+        self.data = None  # 没有指定输出时，生成的 JPEG 字节
+
+    @property
+    def percent_smaller(self):
+        """How much smaller the output is than the input, in percent (None if the input size is unknown)."""
+        if not self.input_size:
+            return None
+        return 100 * float(self.input_size - self.output_size) / self.input_size
+
+
+class _CountingWriter(object):
+    """Wraps a file-like object, counting the bytes written to it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.fileobj.write(data)
+
+
+def _no_log(message):
+    pass
+
+
+class EncodePlan(collections.namedtuple('EncodePlan', [
+        'quality', 'width', 'height', 'sampling', 'h_factor', 'v_factor', 'dct', 'optimize_huffman',
+        'grayscale', 'progressive', 'trellis', 'mcus_per_row', 'restart_interval',
+        'l_table', 'c_table', 'l_reciprocals', 'c_reciprocals', 'mcu_components',
+        'huffman_tables', 'component_table_ids', 'class_tables', 'header_start', 'dht', 'header_end'])):
+    """Everything an encode needs that depends only on its settings, not on the pixels.
+
+    Plans are immutable (their arrays are read-only) and shared through the
+    LRU cache of get_encode_plan. header_start holds the SOI, APP0 and DQT
+    segments and header_end the SOF0, DRI and SOS segments. With
+    optimize_huffman the tables are built per image, so huffman_tables,
+    class_tables and dht are None. A grayscale plan has a single component
+    (one block per MCU, one quantization table and one pair of huffman tables).
+    A progressive plan's header_end is only the SOF2 segment and its dht is
+    empty: every scan brings its own tables and SOS segment. A trellis plan
+    quantizes with trellis_quantize_component instead of rounding.
+    """
+    __slots__ = ()
+
+    @property
+    def class_count(self):
+        """The number of symbol classes (DC and AC of every component)."""
+        return 2 * len(self.component_table_ids)
+
+    def header(self, dht=None):
+        """Returns the header bytes (SOI to SOS), using dht if the plan has no DHT segment of its own."""
+        return self.header_start + (dht or self.dht) + self.header_end
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def get_encode_plan(quality, width, height, sampling='4:4:4', dct='float', optimize_huffman=False,
+                    restart_rows=0, grayscale=False, progressive=False, trellis=False):
+    """Returns the (cached) EncodePlan for these settings.
+
+    width and height are the size of the image (written in the SOF segment);
+    the blocks cover them rounded up to whole MCUs.
+    With grayscale only the luminance is encoded and sampling is ignored.
+    Progressive plans always use optimized huffman tables (built per scan).
+    :raises ValueError: if quality is out of range (see check_quality) or the image is empty.
+    """
+    check_quality(quality)
+    if width < 1 or height < 1:
+        raise ValueError('cannot encode an empty image ({}x{})'.format(width, height))
+    h_factor, v_factor = (1, 1) if grayscale else SAMPLING_FACTORS[sampling]
+    mcus_per_row = -(-width // (8 * h_factor))
+    restart_interval = restart_rows * mcus_per_row
+    if restart_interval > 0xFFFF:
+        raise ValueError('a restart interval of {} MCUs does not fit in a DRI segment'.format(restart_interval))
+
+    # 根据压缩质量重新计算量化表（scale_quant_tables 返回新的表，不修改传入的表）
+    l_table, c_table = scale_quant_tables(quality, L_QUANTIZATION_TABLE, C_QUANTIZATION_TABLE)
+    if dct == 'aan':
+        # AAN 的输出缩放因子并入量化表中，量化时一次除法完成
+        l_reciprocals = quantization_reciprocals(aan_quantization_table(l_table))
+        c_reciprocals = quantization_reciprocals(aan_quantization_table(c_table))
+    else:
+        l_reciprocals = quantization_reciprocals(l_table)
+        c_reciprocals = quantization_reciprocals(c_table)
+    # 每个 MCU 依次是 h_factor x v_factor 个 Y 块、一个 Cb 块和一个 Cr 块（灰度图只有一个 Y 块）
+    if grayscale:
+        mcu_components = numpy.zeros(1, dtype=numpy.int64)
+    else:
+        mcu_components = numpy.repeat(numpy.arange(3), [h_factor * v_factor, 1, 1])
+
+    if optimize_huffman or progressive:
+        huffman_tables = class_tables = dht = None
+        # 每个通道使用的表编号 (DC 表号 << 4 | AC 表号)
+        component_table_ids = (0x00,) if grayscale else (0x00, 0x11, 0x11)
+    else:
+        # Just using the luminance tables for simplicity
+        huffman_tables = (JPEG_HUFFMAN_DC_LUM, JPEG_HUFFMAN_AC_LUM)
+        component_table_ids = (0x00,) if grayscale else (0x00, 0x00, 0x00)
+        class_tables = build_class_tables(huffman_tables, component_table_ids)
+        dht = build_dht_segment(huffman_tables)
+    if progressive:
+        # 渐进式的表和 SOS 写在每个扫描之前，文件头里只有 SOF2
+        dht = b''
+        header_end = build_frame_segment(width, height, h_factor, v_factor, len(component_table_ids), True)
+    else:
+        header_end = build_frame_end(width, height, h_factor, v_factor, component_table_ids, restart_interval)
+
+    arrays = [l_table, c_table, l_reciprocals, c_reciprocals, mcu_components]
+    for lookup in class_tables or ():
+        arrays.extend(lookup)
+    for array in arrays:
+        array.flags.writeable = False
+    return EncodePlan(quality, width, height, sampling, h_factor, v_factor, dct, optimize_huffman or progressive,
+                      grayscale, progressive, trellis, mcus_per_row, restart_interval,
+                      l_table, c_table, l_reciprocals, c_reciprocals, mcu_components,
+                      huffman_tables, component_table_ids, class_tables,
+                      build_frame_start(l_table, None if grayscale else c_table), dht, header_end)
+
+
+def build_optimized_tables(frequencies, component_table_ids):
+    """Returns (class_tables, DHT segment) of the optimal tables for the (6 or 2, 256) symbol frequencies."""
+    # 亮度和色度（Cb、Cr 合并）各一对 DC/AC 表，表号与 component_table_ids 对应；灰度图只有亮度表
+    huffman_tables = [generate_huffman_table(frequencies[0]),
+                      generate_huffman_table(frequencies[1])]
+    if len(component_table_ids) > 1:
+        huffman_tables += [generate_huffman_table(frequencies[2] + frequencies[4]),
+                           generate_huffman_table(frequencies[3] + frequencies[5])]
+    return build_class_tables(huffman_tables, component_table_ids), build_dht_segment(huffman_tables)
+
+
+def build_class_tables(huffman_tables, component_table_ids):
+    """Returns the (codes, lengths) lookups of the symbol classes (DC/AC of Y, Cb and Cr, or only Y)."""
+    lookups = [compile_huffman_table(table) for table in huffman_tables]
+    class_tables = []
+    for table_ids in component_table_ids:
+        class_tables.append(lookups[2 * (table_ids >> 4)])
+        class_tables.append(lookups[2 * (table_ids & 0x0F) + 1])
+    return tuple(class_tables)
+
+
+def encode(source, output=None, quality=50, dct='float', optimize_huffman=False, sampling='4:4:4',
+           streaming=False, restart_rows=0, workers=1, log=None, progress=None, cancelled=None,
+           instrumentation=None, target_size=None, grayscale=None, progressive=False, trellis=False):
+    """Implements JPEG compression.
+
+    :param source: a path, a PIL Image, an (height, width[, channels]) uint8
+        array (anything supporting the buffer protocol, it is not copied) or
+        an inputImg source such as RawYCbCrSource. Uncompressed BMP files are
+        memory mapped rather than decoded.
+    :param output: a path or a file-like object to write the JPEG to. If it is
+        None the JPEG bytes are returned in the data attribute of the stats.
+    :param quality: the quality factor used to scale the quantization tables
+        (MIN_QUALITY to MAX_QUALITY, higher values give smaller files).
+    :param dct: 'float' for the batched matrix DCT or 'aan' for the
+        fixed-point AAN fast DCT (its scaling is folded into quantization).
+    :param optimize_huffman: build optimal huffman tables for this image (one
+        DC/AC pair for luminance and one for chrominance) instead of using the
+        standard luminance tables for every component.
+    :param sampling: the chroma subsampling, '4:4:4', '4:2:2' or '4:2:0'.
+    :param streaming: encode one MCU row (8 or 16 pixel rows) at a time and
+        write its bytes to the output before reading the next one, so the
+        working memory is bounded by the image width (optimize_huffman then
+        reads the image twice).
+    :param restart_rows: split the scan into restart intervals of that many
+        MCU rows (DRI segment and RST markers); the intervals are independent
+        and are encoded by a pool of workers processes.
+    :param log: an optional callable receiving progress messages.
+    :param progress: an optional callable receiving the percentage (0-100)
+        of blocks encoded so far, called after every strip (once per MCU row
+        when streaming, once per stage otherwise).
+    :param cancelled: an optional callable polled between strips and stages;
+        when it returns True the encode stops with EncodeCancelled (a
+        partially written output path is removed).
+    :param instrumentation: an optional instrumentation.Instrumentation that
+        records the duration, blocks, bytes (and memory peak) of each stage.
+        The stage durations of this encode are also in stats.timings (summed
+        over the worker processes with restart_rows).
+    :param target_size: pick the quality instead: the lowest quality factor
+        whose output fits in target_size bytes is searched for, taking the DCT
+        once and only requantizing and sizing the scan for each candidate
+        (quality is ignored; whole-image mode only). If even MAX_QUALITY does
+        not fit, that smallest output is written; check stats.output_size.
+    :param grayscale: True to encode only the luminance (a single component
+        JPEG, sampling is ignored), False to always encode Y, Cb and Cr. None
+        decides per image: grayscale sources ('L' images, 2-D arrays) are
+        encoded as grayscale and, in whole-image mode, so are color images
+        whose chroma stays within inputImg.FLAT_CHROMA_TOLERANCE of neutral.
+    :param progressive: write a progressive (SOF2) JPEG: a scan of the DC
+        terms, then bands of AC coefficients sent a few bits at a time and
+        refined in later scans (the scan script of libjpeg). Every scan gets
+        optimized huffman tables, so optimize_huffman is implied (whole-image
+        mode only).
+    :param trellis: rate-distortion optimized quantization: per block, zero
+        coefficients or round them towards zero where the huffman bits saved
+        outweigh the added error (compressAlgorithm.TRELLIS_LAMBDA, the error
+        of each coefficient weighted by its squared quantization step). Files
+        are smaller at the same PSNR, but quantization is much slower.
+    :returns: EncodeStats -- the sizes, dimensions and timings of the encode.
+    :raises ValueError: for a quality out of range or settings that do not go together.
+    """
+    check_quality(quality)
+    if target_size is not None and (streaming or restart_rows):
+        raise ValueError('target_size needs the whole image at once (no streaming or restart_rows)')
+    if progressive and (streaming or restart_rows or target_size is not None):
+        raise ValueError('progressive needs the whole image at once (no streaming, restart_rows or target_size)')
+    log = log or _no_log
+    listener = instrumentation or NO_INSTRUMENTATION
+    # 本次编码自己的记录，各阶段的耗时填进 stats.timings；每条记录同时加到调用方的 instrumentation 上
+    instrumentation = Instrumentation(listener.trace_memory, parent=listener)
+    stats = EncodeStats()
+    start_time = time.time()
+
+    # Extract the data into pixel matrices of the Y, Cb, Cr components
+    # BYTE是无符号字节 RGB是0到255储存， 而YUV是-128到127，读取时颜色转换和值域调整一次完成
+    log('读取图像数据，转换为YCbCr并将值域从(0,255)调整至(-128,127)' + '\n')
+    image = open_source(source)
+    stats.input_size = image.size
+    stats.original_width, stats.original_height = image.width, image.height
+    if not image.width or not image.height:
+        raise ValueError('cannot encode an empty image ({}x{})'.format(image.width, image.height))
+    whole_planes = None
+    if grayscale is None:
+        grayscale = image.grayscale
+        if not grayscale and not streaming and not restart_rows:
+            # 以彩色保存的灰度图（扫描件等）：整幅编码时先读入图像，色度都接近中性就只编码亮度。
+            # 按原来的大小读取，确定是否彩色之后再补齐成整数个 MCU
+            with instrumentation.stage('read') as stage:
+                whole_planes = image.read_planes(0, image.height, image.width, *SAMPLING_FACTORS[sampling])
+                stage.bytes = sum(plane.nbytes for plane in whole_planes)
+            grayscale = chroma_is_flat(whole_planes)
+    stats.grayscale = grayscale
+    components = 1 if grayscale else 3
+    h_factor, v_factor = (1, 1) if grayscale else SAMPLING_FACTORS[sampling]
+    # 编码的宽高向上补齐到整数个 MCU（4:4:4 时为8的倍数），补上的像素重复右边和下边的边缘像素；
+    # SOF 中写入原来的宽高，解码器会裁掉补上的部分
+    width = -(-image.width // (8 * h_factor)) * 8 * h_factor
+    height = -(-image.height // (8 * v_factor)) * 8 * v_factor
+    stats.width, stats.height = image.width, image.height
+    log('宽：' + str(image.width) + 'px' + '   高：' + str(image.height) + 'px' + '\n')
+    if grayscale:
+        log('灰度图像，只编码亮度通道' + '\n')
+    if whole_planes is not None:
+        whole_planes = pad_planes(whole_planes[:components], width, height, h_factor, v_factor)
+
+    # 量化表、倒数表和文件头只与参数有关，相同参数（如同样大小的缩略图）的编码共用一个 EncodePlan
+    plan = get_encode_plan(quality, image.width, image.height, sampling, dct, optimize_huffman, restart_rows,
+                           grayscale, progressive, trellis)
+    if target_size is None:
+        _log_quant_tables(plan, log)
+
+    mcus_per_row = plan.mcus_per_row
+    if restart_rows:
+        # 每 restart_rows 行 MCU 为一个重启间隔，各间隔互相独立，可以分给多个进程编码
+        strip_height = 8 * v_factor * restart_rows
+    elif streaming:
+        # 流式编码时每次只处理一行 MCU（8 或 16 行像素）
+        strip_height = 8 * v_factor
+    else:
+        strip_height = height
+
+    # 两遍编码（先统计频率）时进度按两倍的行数计算；块数与行数成正比，按行计算即可
+    passes = 2 if optimize_huffman and (streaming or restart_rows) else 1
+    if progressive:
+        # 渐进式每写完一个扫描报告一次
+        passes = len(GRAYSCALE_SCAN_SCRIPT if grayscale else COLOR_SCAN_SCRIPT)
+    encoded_rows = [0]
+
+    def check_cancelled():
+        if cancelled is not None and cancelled():
+            raise EncodeCancelled()
+
+    def report(rows):
+        encoded_rows[0] += rows
+        if progress is not None:
+            progress(100 * encoded_rows[0] // (passes * height))
+        check_cancelled()
+
+    def strip_blocks(rows):
+        # 一条 rows 行像素的条带含有的 8x8 块数（所有通道）
+        return rows // (8 * v_factor) * mcus_per_row * len(plan.mcu_components)
+
+    def strips():
+        if whole_planes is not None:
+            # 检测灰度时已经读入了整幅图像
+            yield whole_planes
+            return
+        for top in range(0, height, strip_height):
+            check_cancelled()
+            bottom = min(top + strip_height, height)
+            with instrumentation.stage('read', blocks=strip_blocks(bottom - top)) as stage:
+                planes = image.read_planes(top, min(bottom, image.height), image.width, h_factor, v_factor,
+                                           components)
+                planes = pad_planes(planes, width, bottom - top, h_factor, v_factor)
+                stage.bytes = sum(plane.nbytes for plane in planes)
+            yield planes
+
+    def strip_rows(index):
+        return min(strip_height, height - index * strip_height)
+
+    if output is None:
+        fileobj = io.BytesIO()
+    elif isinstance(output, (str, bytes)) or hasattr(output, '__fspath__'):
+        fileobj = open(output, 'wb')
+    else:
+        fileobj = output
+    filepointer = _CountingWriter(fileobj)
+
+    # instrumentation 记录各阶段的耗时、块数、字节数（和内存峰值）；调用方的 instrumentation 统计编码次数
+    with listener.encoding():
+        executor = ProcessPoolExecutor(max_workers=workers) if restart_rows and workers > 1 else None
+        scan = None
+        try:
+            if target_size is not None:
+                # 只做一次 DCT，之后每个候选质量因子只重新量化并估算大小
+                coefficients = take_strip_dct(next(strips()), h_factor, v_factor, dct, log, instrumentation)
+                check_cancelled()
+                plan, class_tables, dht, scan = fit_target_size(coefficients, plan, target_size, log,
+                                                                instrumentation, check_cancelled)
+                _log_quant_tables(plan, log)
+            elif progressive:
+                # 各个扫描都从同一份量化后的系数中取出自己的频段和位
+                coefficients = take_strip_dct(next(strips()), h_factor, v_factor, dct, log, instrumentation)
+                quantized = quantize_blocks(coefficients, plan, log, instrumentation)
+                del coefficients
+                check_cancelled()
+            elif not restart_rows and not streaming:
+                symbols, bits, classes = encode_strip_symbols(next(strips()), plan, [0, 0, 0], log, instrumentation)
+                check_cancelled()
+
+            # target_size 模式下表已经随质量因子一起选好，渐进式则每个扫描各自生成
+            if optimize_huffman and target_size is None and not progressive:
+                log('统计符号频率，生成优化的哈夫曼表' + '\n')
+                # 第一遍：统计各类符号出现的次数，亮度和色度（Cb、Cr 合并）各生成一对 DC/AC 表
+                if restart_rows:
+                    # 各个重启间隔分别统计（每个间隔的DC预测都从0开始），可以并行
+                    frequencies = numpy.zeros((plan.class_count, 256), dtype=numpy.int64)
+                    arguments = ((planes, plan, instrumentation.fork()) for planes in strips())
+                    segments = map_in_order(executor, count_segment_frequencies, arguments, 2 * workers)
+                    for index, (segment_frequencies, segment_instrumentation) in enumerate(segments):
+                        frequencies += segment_frequencies
+                        instrumentation.merge(segment_instrumentation)
+                        report(strip_rows(index))
+                elif streaming:
+                    # 流式编码时要先把整幅图像过一遍，只保留统计结果
+                    frequencies = numpy.zeros((plan.class_count, 256), dtype=numpy.int64)
+                    dc_predictors = [0, 0, 0]
+                    for planes in strips():
+                        strip_symbols, _, strip_classes = encode_strip_symbols(
+                            planes, plan, dc_predictors, instrumentation=instrumentation)
+                        with instrumentation.stage('huffman_tables'):
+                            frequencies += count_class_frequencies(strip_symbols, strip_classes, plan.class_count)
+                        report(planes[0].shape[0])
+                else:
+                    with instrumentation.stage('huffman_tables'):
+                        frequencies = count_class_frequencies(symbols, classes, plan.class_count)
+                with instrumentation.stage('huffman_tables'):
+                    class_tables, dht = build_optimized_tables(frequencies, plan.component_table_ids)
+            elif target_size is None:
+                class_tables = plan.class_tables
+                dht = None
+
+            check_cancelled()
+            log('写入文件头（SOI、APP0、DQT、{}）'.format('SOF2' if progressive else 'DHT、SOF0、SOS') + '\n')
+            with instrumentation.stage('container') as stage:
+                header = plan.header(dht)
+                filepointer.write(header)
+                stage.bytes = len(header)
+
+            if restart_rows:
+                log('按重启间隔编码扫描数据（{} 个进程）'.format(workers) + '\n')
+                # 各个间隔的字节按顺序拼接，间隔之间插入 RST0-RST7 标记
+                arguments = ((planes, plan, class_tables, instrumentation.fork()) for planes in strips())
+                segments = map_in_order(executor, encode_restart_segment, arguments, 2 * workers)
+                for index, (segment, segment_instrumentation) in enumerate(segments):
+                    if index:
+                        filepointer.write(bytes([0xFF, 0xD0 + (index - 1) % 8]))  # RSTm marker
+                    filepointer.write(segment)
+                    instrumentation.merge(segment_instrumentation)
+                    report(strip_rows(index))
+            elif streaming:
+                log('逐行(MCU)编码并写入扫描数据' + '\n')
+                # 每编码完一行 MCU 就把完整的字节写入文件，不足一个字节的位留到下一行
+                writer = EntropyWriter()
+                dc_predictors = [0, 0, 0]
+                for index, planes in enumerate(strips()):
+                    symbols, bits, classes = encode_strip_symbols(
+                        planes, plan, dc_predictors, log if index == 0 else None, instrumentation)
+                    with instrumentation.stage('entropy', blocks=strip_blocks(planes[0].shape[0])) as stage:
+                        values, lengths = get_kernel('huffman')(symbols, bits, classes, class_tables)
+                        data = writer.write(values, lengths).tobytes()
+                        filepointer.write(data)
+                        stage.bytes = len(data)
+                    report(planes[0].shape[0])
+                with instrumentation.stage('entropy') as stage:
+                    data = writer.flush().tobytes()
+                    filepointer.write(data)
+                    stage.bytes = len(data)
+            elif progressive:
+                log('逐个扫描编码渐进式数据（DHT、SOS和熵编码数据）' + '\n')
+                for data in encode_progressive_scans(quantized, plan, instrumentation):
+                    filepointer.write(data)
+                    report(height)
+            else:
+                log('哈夫曼编码(熵编码)' + '\n')
+                with instrumentation.stage('entropy', blocks=strip_blocks(height)) as stage:
+                    if scan is None:
+                        # Huffman encode the whole scan
+                        values, lengths = get_kernel('huffman')(symbols, bits, classes, class_tables)
+                        # Pack the scan data straight into bytes (padded and byte stuffed)
+                        scan = get_kernel('pack')(values, lengths).tobytes()
+                    filepointer.write(scan)
+                    stage.bytes = len(scan)
+                report(height)
+
+            log('写入EOI文件尾' + '\n')
+            # EOI
+            with instrumentation.stage('container', nbytes=2):
+                filepointer.write(bytes([0xFF, 0xD9]))
+        except BaseException:
+            if output is not None and fileobj is not output:
+                # 不留下写了一半的文件
+                fileobj.close()
+                os.remove(output)
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if fileobj is not output:
+                if output is None:
+                    stats.data = fileobj.getvalue()
+                fileobj.close()
+
+    log('生成JPEG文件' + '\n')
+    stats.output_size = filepointer.count
+    stats.quality = plan.quality
+    stats.timings = dict((name, record.seconds) for name, record in instrumentation.stages.items())
+    stats.timings['total'] = time.time() - start_time
+    return stats
+
+
+def _log_quant_tables(plan, log):
+    log('质量因子：' + str(plan.quality) + '%' + '\n')
+    log('根据质量因子调整量化表' + '\n')
+    # 输出调整后的量化表
+    log('调整后的亮度量化表：')
+    log(''.join('[ ' + ' '.join(str(value) for value in row) + ' ]\n' for row in plan.l_table))
+    if not plan.grayscale:
+        log('调整后的色度量化表：')
+        log(''.join('[ ' + ' '.join(str(value) for value in row) + ' ]\n' for row in plan.c_table))
+
+
+def fit_target_size(coefficients, plan, target_size, log=_no_log, instrumentation=NO_INSTRUMENTATION,
+                    check_cancelled=None):
+    """Binary searches the lowest quality factor whose JPEG fits in target_size bytes.
+
+    :param coefficients: the (Y, Cb, Cr) DCT coefficients of the whole image
+        (see take_strip_dct); they do not depend on the quality.
+    :param plan: the EncodePlan of any quality with the wanted settings.
+    :returns: (plan, class_tables, dht, scan) -- the plan of the chosen
+        quality, its class tables and DHT segment (None for the plan's own)
+        and the packed, byte stuffed scan data.
+    """
+    sizes = {}
+    # 只保留目前满足目标的最小质量因子的符号数组（整幅图的符号流很大，不为每个试过的质量因子都保留）
+    kept = []
+
+    def symbol_pass(quality):
+        # 量化、生成符号，再由符号频率算出文件大小（不生成码字，也不打包）
+        quality_plan = get_encode_plan(quality, plan.width, plan.height, plan.sampling, plan.dct,
+                                       plan.optimize_huffman, grayscale=plan.grayscale, trellis=plan.trellis)
+        symbols, bits, classes = quantize_strip(coefficients, quality_plan, [0, 0, 0],
+                                                instrumentation=instrumentation)
+        with instrumentation.stage('huffman_tables'):
+            frequencies = count_class_frequencies(symbols, classes, quality_plan.class_count)
+            if quality_plan.optimize_huffman:
+                class_tables, dht = build_optimized_tables(frequencies, quality_plan.component_table_ids)
+            else:
+                class_tables, dht = quality_plan.class_tables, None
+            scan_bytes = (count_scan_bits(frequencies, class_tables) + 7) // 8
+        size = len(quality_plan.header(dht)) + scan_bytes + 2
+        if check_cancelled is not None:
+            check_cancelled()
+        return size, (quality, quality_plan, (symbols, bits, classes), class_tables, dht)
+
+    def candidate_size(quality):
+        if quality not in sizes:
+            size, result = symbol_pass(quality)
+            log('质量因子 {}：约 {} bytes'.format(quality, size) + '\n')
+            sizes[quality] = size
+            if size <= target_size and (not kept or quality < kept[0][0]):
+                kept[:] = [result]
+        return sizes[quality]
+
+    log('搜索满足目标大小（{} bytes）的质量因子'.format(target_size) + '\n')
+    # 文件大小随质量因子增大而减小，找估算大小不超过目标的最小质量因子
+    low, high = MIN_QUALITY, MAX_QUALITY
+    while low < high:
+        middle = (low + high) // 2
+        if candidate_size(middle) <= target_size:
+            high = middle
+        else:
+            low = middle + 1
+    # 估算没有计入 0xFF 之后填充的 0x00，打包后超出目标时再往小文件的方向试
+    quality = low
+    while True:
+        if kept and kept[0][0] == quality:
+            result = kept.pop()
+        else:
+            # 没有保留符号数组的质量因子（搜索到的是 MAX_QUALITY，或打包后超出了目标）重新生成一次
+            result = symbol_pass(quality)[1]
+        _, quality_plan, (symbols, bits, classes), class_tables, dht = result
+        del result
+        with instrumentation.stage('entropy', blocks=len(coefficients[0]) * len(plan.mcu_components)) as stage:
+            values, lengths = get_kernel('huffman')(symbols, bits, classes, class_tables)
+            del symbols, bits, classes
+            scan = get_kernel('pack')(values, lengths).tobytes()
+            stage.bytes = len(scan)
+        del values, lengths
+        if len(quality_plan.header(dht)) + len(scan) + 2 <= target_size or quality >= MAX_QUALITY:
+            return quality_plan, class_tables, dht, scan
+        quality += 1
+
+
+def build_frame_start(scaled_l_quant_table, scaled_c_quant_table, log=_no_log):
+    """Returns the SOI, APP0 and DQT segments (without the chrominance table if it is None)."""
+    log('写入SOI文件头' + '\n')
+    # SOI文件头 JPEG文件的开始2个字节都是FF D8这是JPEG协议规定的
+    header = bytearray([0xFF, 0xD8])  # SOI
+
+    log('写入APP0图像识别信息' + '\n')
+    # APP0图像识别信息
+    header += bytes([0xFF, 0xE0])  # APP0
+    header += struct.pack('>H', 16)  # Length of APP0, including the length (16 bytes)
+    header += b'JFIF\0'
+    header += bytes([1, 2])  # JFIF version 1.02
+    header += bytes([1])  # Units (DPI) 单位密度
+    header += struct.pack('>HH', 64, 64)  # Arbitrary X, Y DPI 水平、垂直像素密度
+    header += bytes([0, 0])  # X, Y thumbnail length 缩略图像素
+
+    log('写入DQT定义量化表' + '\n')
+    # Encode the quantization table
+    tables = [scaled_l_quant_table] if scaled_c_quant_table is None else [scaled_l_quant_table, scaled_c_quant_table]
+    header += bytes([0xFF, 0xDB])  # DQT Marker 段标识类型
+    header += struct.pack('>H', 2 + 65 * len(tables))  # Length (132 for two tables), including the length bytes
+    # 亮度量化表（表号 0）和色度量化表（表号 1），按 Zigzag 顺序写入
+    for identifier, table in enumerate(tables):
+        header += bytes([identifier])  # Table value sizes and table identifier
+        header += numpy.asarray(table).reshape(64)[ZIGZAG_INDEX].astype(numpy.uint8).tobytes()
+    return bytes(header)
+
+
+def build_dht_segment(huffman_tables, log=_no_log, table_ids=None):
+    """Returns the DHT segment defining huffman_tables (DC 0, AC 0, DC 1, AC 1, ... unless table_ids are given)."""
+    log('写入DHT定义huffman表' + '\n')
+    # 表类型与编号：高四位 0 为 DC 表、1 为 AC 表，低四位为表编号
+    if table_ids is None:
+        table_ids = [(index % 2) << 4 | index // 2 for index in range(len(huffman_tables))]
+    tables = b''.join(bytes([table_id]) + get_huffman_table_bytes(table)
+                      for table_id, table in zip(table_ids, huffman_tables))
+    # Write the length of the huffman tables plus the 2 bytes of the length bytes
+    return bytes([0xFF, 0xC4]) + struct.pack('>H', len(tables) + 2) + tables
+
+
+def build_frame_end(width, height, h_factor, v_factor, component_table_ids, restart_interval=0, log=_no_log):
+    """Returns the SOF0, DRI (if restart_interval is set) and SOS segments.
+
+    The frame has a component for every entry of component_table_ids: Y, Cb
+    and Cr, or only Y for a grayscale image.
+    """
+    header = build_frame_segment(width, height, h_factor, v_factor, len(component_table_ids), log=log)
+
+    if restart_interval:
+        log('写入DRI定义重启间隔' + '\n')
+        header += bytes([0xFF, 0xDD])  # DRI marker
+        header += struct.pack('>HH', 4, restart_interval)  # Length, MCUs in each restart interval
+
+    return header + build_scan_segment(range(len(component_table_ids)), component_table_ids, log=log)
+
+
+def build_frame_segment(width, height, h_factor, v_factor, components, progressive=False, log=_no_log):
+    """Returns the SOF0 (or with progressive, SOF2) segment of a frame of 1 (Y) or 3 (Y, Cb, Cr) components."""
+    log('写入SOF{}图像基本信息'.format(2 if progressive else 0) + '\n')
+    # Start of frame
+    header = bytearray([0xFF, 0xC2 if progressive else 0xC0])  # SOF0 (baseline) or SOF2 (progressive) marker
+    # Length (0x11 for three components), precision (8 bits), size, components
+    header += struct.pack('>HBHHB', 8 + 3 * components, 8, height, width, components)
+    # 采样系数是实际采样方式与最高采样系数之比，而最高采样系数一般＝0.5（分数表示为1 /
+    # 2）。比如说，垂直采样系数＝2，那么2×0.5＝1，表示实际采样方式是每个点采一个样，也就是逐点采样；如果垂直采样系数＝1，那么：1×0.5＝0.5（分数表示为1 / 2），表示每２个点采一个样
+    header += bytes([0x01, h_factor << 4 | v_factor, 0x00])  # Y: id, sampling factors, quantization table
+    if components > 1:
+        header += bytes([0x02, 0x11, 0x01])  # Cb: id, sampling frequency of 1 to 1, quantization table
+        header += bytes([0x03, 0x11, 0x01])  # Cr: id, sampling frequency of 1 to 1, quantization table
+    return bytes(header)
+
+
+def build_scan_segment(components, table_ids, start=0, end=63, high=0, low=0, log=_no_log):
+    """Returns the SOS segment of a scan of the components (indexes, 0 for Y) with their huffman table_ids.
+
+    start and end select the band of zigzag positions and high and low are the
+    successive approximation bit positions (a baseline scan is 0-63, 0, 0).
+    """
+    log('写入SOS扫描行' + '\n')
+    # Scan
+    header = bytearray([0xFF, 0xDA])  # Scan component
+    header += struct.pack('>HB', 6 + 2 * len(components), len(components))  # Length (0x0C for three components), component count
+    for component, component_table_ids in zip(components, table_ids):
+        header += bytes([component + 1, component_table_ids])  # Component, DC and AC huffman table identifiers
+    header += bytes([start, end, high << 4 | low])  # Spectral selection start, end, successive approximation
+    return bytes(header)
+
+
+def strip_block_count(lum, h_factor, v_factor, components=3):
+    """The number of 8x8 blocks (of all components) in a strip whose luminance plane is lum."""
+    return lum.size // 64 * (h_factor * v_factor + components - 1) // (h_factor * v_factor)
+
+
+def encode_strip_symbols(planes, plan, dc_predictors, log=None, instrumentation=NO_INSTRUMENTATION):
+    """Turns a strip of whole MCU rows of the image into entropy coding symbols.
+
+    planes are the level-shifted (Y, Cb, Cr) 2-D planes of the strip, encoded with the
+    sampling, DCT and quantization of the EncodePlan plan. dc_predictors
+    carries the DPCM state from one strip to the next. log is an optional
+    callable receiving the progress messages; instrumentation records the
+    blocks, dct, quantize and symbols stages.
+    """
+    coefficients = take_strip_dct(planes, plan.h_factor, plan.v_factor, plan.dct, log, instrumentation)
+    return quantize_strip(coefficients, plan, dc_predictors, log, instrumentation)
+
+
+def take_strip_dct(planes, h_factor, v_factor, dct, log=None, instrumentation=NO_INSTRUMENTATION):
+    """Returns the DCT coefficients of a strip, as (Y, Cb, Cr) stacks of MCUs of shape (M, blocks, 8, 8).
+
+    They do not depend on the quality factor (the AAN scaling is part of the
+    quantization), so they can be quantized at several qualities. A grayscale
+    strip (only the Y plane) gives only the Y stack.
+    """
+    # 将三个通道分分离， 然后每个通道再从上至下， 从左至右 分割成诺干个 MCU（MCU大小由最高采样系数决定），
+    lum = planes[0]
+    blocks = strip_block_count(lum, h_factor, v_factor, len(planes))
+    with instrumentation.stage('blocks', blocks=blocks) as stage:
+        # 下面的函数将决定 MCU 块的大小，与采样系数有关：每个 MCU 含 h_factor x v_factor 个亮度块，
+        # 色度通道先按采样系数求平均（下采样），每个 MCU 只含一个 Cb 块和一个 Cr 块；
+        # 源已经给出下采样后的色度（如 I420 的原始帧）时直接使用
+        matrices = [create_mcu_matrices(lum, h_factor, v_factor)]
+        for chroma in planes[1:]:
+            if chroma.shape == lum.shape:
+                chroma = downsample_band(chroma, h_factor, v_factor)
+            matrices.append(create_mcu_matrices(chroma))
+        stage.bytes = sum(component.nbytes for component in matrices)
+
+    if log:
+        log('进行DCT变换' + '\n')
+    with instrumentation.stage('dct', blocks=blocks) as stage:
+        # Take DCT of all
+        transform = take_aan_dct_of_component if dct == 'aan' else get_kernel('dct')
+        matrices = tuple(transform(component) for component in matrices)
+        stage.bytes = sum(component.nbytes for component in matrices)
+    return matrices
+
+
+def quantize_strip(coefficients, plan, dc_predictors, log=None, instrumentation=NO_INSTRUMENTATION):
+    """Quantizes the DCT coefficients of a strip (see take_strip_dct) and turns them into symbols.
+
+    The coefficients are left unchanged.
+    """
+    blocks = len(coefficients[0]) * len(plan.mcu_components)
+    matrices = quantize_blocks(coefficients, plan, log, instrumentation)
+
+    if log:
+        log('差分脉冲编码调制(DPCM)、Zigzag编码与行程长度编码(RLE)' + '\n')
+    with instrumentation.stage('symbols', blocks=blocks) as stage:
+        # 按照JPEG格式要求排列YCbCr通道顺序，接下来编码
+        # Interleave the components
+        # 每个 MCU 依次是它的 Y 块、Cb 块、Cr 块，展开成 (N, 8, 8) 的块序列
+        interleaved = numpy.concatenate(matrices, axis=1).reshape(-1, 8, 8)
+        block_components = numpy.tile(plan.mcu_components, len(matrices[0]))
+
+        # 第一个数值为DC直流分量，对直流分量采用DPCM编码，因为该值通常较大，而相邻的8x8图像数据之间的差值变化不大。
+        # 所谓DCPM编码，听起来高大上，实际就是将每一个（第一个除外）MCU的直流分量（对应MCU矩阵左上角的值）都减去上一个MCU的直流分量的值
+        # 这样可以增加数据中0的数目，从而更好的压缩
+        # 然后对每个块以左上角开始以 z 字型展开，再对连续的0进行行程长度编码，整个扫描一次完成
+        symbols, bits, classes = get_kernel('symbols')(interleaved, block_components, dc_predictors)
+        stage.bytes = symbols.nbytes + bits.nbytes + classes.nbytes
+    return symbols, bits, classes
+
+
+def quantize_blocks(coefficients, plan, log=None, instrumentation=NO_INSTRUMENTATION):
+    """Quantizes the DCT coefficients of a strip (see take_strip_dct), returning the int16 (Y, Cb, Cr) stacks."""
+    if log:
+        log('进行量化取整' + '\n')
+    with instrumentation.stage('quantize', blocks=len(coefficients[0]) * len(plan.mcu_components)) as stage:
+        if plan.trellis:
+            # 码长取计划使用的 AC 表；优化的哈夫曼表（以及渐进式的表）在量化之后才生成，按标准表估算
+            if plan.class_tables:
+                ac_code_lengths = [plan.class_tables[2 * index + 1][1] for index in range(len(coefficients))]
+            else:
+                ac_code_lengths = [JPEG_HUFFMAN_AC_LUM_LOOKUP[1]] * len(coefficients)
+            matrices = [trellis_quantize_component(coefficients[0], plan.l_reciprocals, plan.l_table,
+                                                   ac_code_lengths[0])]
+            matrices += [trellis_quantize_component(chroma, plan.c_reciprocals, plan.c_table, lengths)
+                         for chroma, lengths in zip(coefficients[1:], ac_code_lengths[1:])]
+        else:
+            # Quantize all (multiply by the reciprocal tables and round to int16 in one pass)
+            quantize = get_kernel('quantize')
+            matrices = [quantize(coefficients[0], plan.l_reciprocals)]
+            matrices += [quantize(chroma, plan.c_reciprocals) for chroma in coefficients[1:]]
+        stage.bytes = sum(component.nbytes for component in matrices)
+    return matrices
+
+
+def encode_progressive_scans(quantized, plan, instrumentation=NO_INSTRUMENTATION):
+    """Yields the scans of a progressive JPEG, each with its DHT (if it needs tables) and SOS segments.
+
+    :param quantized: the quantized (Y, Cb, Cr) stacks of the whole image (see quantize_blocks).
+    :param plan: a progressive EncodePlan.
+    """
+    mcu_rows = -(-plan.height // (8 * plan.v_factor))
+    # 交错的 DC 扫描按 MCU 顺序排列各块；非交错的 AC 扫描按各通道自己的光栅顺序（亮度块要重新排列），
+    # 而且只含覆盖图像的块：补齐 MCU 时多出的整行、整列亮度块不编码
+    dc_values = numpy.concatenate([component[:, :, 0, 0] for component in quantized], axis=1).reshape(-1)
+    block_components = numpy.tile(plan.mcu_components, len(quantized[0]))
+    lum_blocks = quantized[0].reshape(mcu_rows, plan.mcus_per_row, plan.v_factor, plan.h_factor, 64) \
+        .transpose(0, 2, 1, 3, 4).reshape(mcu_rows * plan.v_factor, plan.mcus_per_row * plan.h_factor, 64)
+    raster = [lum_blocks[:-(-plan.height // 8), :-(-plan.width // 8)].reshape(-1, 64)]
+    raster += [chroma.reshape(-1, 64) for chroma in quantized[1:]]
+
+    for components, start, end, high, low in (GRAYSCALE_SCAN_SCRIPT if plan.grayscale else COLOR_SCAN_SCRIPT):
+        blocks = len(dc_values) if start == 0 else len(raster[components[0]])
+        with instrumentation.stage('entropy', blocks=blocks) as stage:
+            if start == 0 and high:
+                items = dc_refine_scan(dc_values, low)
+            elif start == 0:
+                items = dc_first_scan(dc_values, block_components, low)
+            else:
+                items = ac_scan(raster[components[0]][:, ZIGZAG_INDEX], start, end, high, low)
+            stage.bytes = sum(item.nbytes for item in items)
+
+        # 亮度用 0 号表、色度用 1 号表：DC 扫描每个通道的表号在高四位，AC 扫描在低四位
+        table_count = int(items[3].max()) + 1 if (items[3] != RAW_BITS).any() else 0
+        with instrumentation.stage('huffman_tables'):
+            frequencies = count_scan_frequencies(items[0], items[3], table_count)
+            huffman_tables = [generate_huffman_table(frequency) for frequency in frequencies]
+            class_tables = [compile_huffman_table(table) for table in huffman_tables]
+        if start == 0:
+            table_ids = list(range(table_count))
+            component_table_ids = [min(component, 1) << 4 for component in components]
+        else:
+            table_ids = [0x10 | min(components[0], 1)]
+            component_table_ids = [min(components[0], 1)]
+
+        with instrumentation.stage('container') as stage:
+            segments = build_dht_segment(huffman_tables, table_ids=table_ids) if huffman_tables else b''
+            segments += build_scan_segment(components, component_table_ids, start, end, high, low)
+            stage.bytes = len(segments)
+        with instrumentation.stage('entropy') as stage:
+            values, lengths = encode_scan_items(*items, class_tables=class_tables)
+            data = get_kernel('pack')(values, lengths).tobytes()
+            stage.bytes = len(data)
+        yield segments + data
+
+
+def encode_restart_segment(planes, plan, class_tables, instrumentation=NO_INSTRUMENTATION):
+    """Encodes the planes of a strip as an independent restart interval.
+
+    :returns: (its entropy coded bytes, instrumentation) -- the
+        instrumentation (a fork() when running in a worker) holds the stages
+        of this segment, for the caller to merge.
+    """
+    with instrumentation.encoding():
+        symbols, bits, classes = encode_strip_symbols(planes, plan, [0, 0, 0], instrumentation=instrumentation)
+        with instrumentation.stage('entropy', blocks=strip_block_count(planes[0], plan.h_factor, plan.v_factor,
+                                                                       len(planes))) as stage:
+            values, lengths = get_kernel('huffman')(symbols, bits, classes, class_tables)
+            data = get_kernel('pack')(values, lengths).tobytes()
+            stage.bytes = len(data)
+    return data, instrumentation
+
+
+def count_segment_frequencies(planes, plan, instrumentation=NO_INSTRUMENTATION):
+    """Counts the symbols of a restart interval per symbol class (for optimized huffman tables).
+
+    :returns: (the (plan.class_count, 256) frequencies, instrumentation) as in encode_restart_segment.
+    """
+    with instrumentation.encoding():
+        symbols, _, classes = encode_strip_symbols(planes, plan, [0, 0, 0], instrumentation=instrumentation)
+        with instrumentation.stage('huffman_tables'):
+            frequencies = count_class_frequencies(symbols, classes, plan.class_count)
+    return frequencies, instrumentation
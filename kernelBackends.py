@@ -0,0 +1,326 @@
+"""Selects the implementation (backend) of each hot stage of the encoder.
+
+    JPEG_KERNEL_BACKEND=reference python batchCompress.py photos/ -o out/
+    JPEG_KERNEL_BACKEND=numpy,pack=numba python batchCompress.py photos/ -o out/
+    python kernelBackends.py  # checks every backend against the NumPy one
+
+The stages are the float DCT, quantization, symbol generation (DPCM, zigzag
+and run length encoding), huffman coding and bit packing. The 'numpy' backend
+is the vectorized code of compressAlgorithm and the default; 'reference' runs
+the original block by block code (encode_dc, zigzag_all, run_length_encode,
+huffman_encode and dump_scan_to_string of compressAlgorithm), slow but easy to
+check by eye; 'numba' compiles the scalar bit packing loop and is only
+available when numba is installed. A backend that lacks a stage uses the
+NumPy kernel for it.
+"""
+import argparse
+import collections
+import functools
+import os
+import sys
+
+import numpy
+
+from compressAlgorithm import DCT_TABLE, take_dct_of_component, quantize_component, generate_symbols
+from compressAlgorithm import huffman_encode_symbols, pack_bits
+from compressAlgorithm import encode_dc, zigzag_all, run_length_encode, huffman_encode, dump_scan_to_string
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+STAGES = ('dct', 'quantize', 'symbols', 'huffman', 'pack')
+# 选择后端的环境变量：一个后端名，后面可以跟 阶段=后端 逐个指定，如 'numpy,pack=numba'
+BACKEND_VARIABLE = 'JPEG_KERNEL_BACKEND'
+DEFAULT_BACKEND = 'numpy'
+
+# 后端名 -> {阶段: 函数}；不可用的后端记录原因
+BACKENDS = collections.OrderedDict()
+UNAVAILABLE_BACKENDS = {}
+
+
+def register_kernel(backend, stage):
+    """Returns a decorator registering a function as the kernel of stage in backend."""
+    if stage not in STAGES:
+        raise ValueError('unknown kernel stage: ' + stage)
+
+    def register(function):
+        BACKENDS.setdefault(backend, {})[stage] = function
+        resolve_backends.cache_clear()
+        return function
+    return register
+
+
+@functools.lru_cache(maxsize=16)
+def resolve_backends(selection):
+    """Returns the {stage: kernel} of a selection such as 'numpy', 'reference' or 'numpy,pack=numba'."""
+    default = DEFAULT_BACKEND
+    overrides = {}
+    for item in filter(None, (part.strip() for part in selection.split(','))):
+        stage, _, backend = item.rpartition('=')
+        if not stage:
+            default = backend
+        elif stage not in STAGES:
+            raise ValueError('unknown kernel stage: ' + stage)
+        else:
+            overrides[stage] = backend
+    for stage, backend in [(None, default)] + list(overrides.items()):
+        if backend in UNAVAILABLE_BACKENDS:
+            raise ValueError('the {} backend is not available: {}'.format(backend, UNAVAILABLE_BACKENDS[backend]))
+        if backend not in BACKENDS:
+            raise ValueError('unknown kernel backend: ' + backend)
+        if stage is not None and stage not in BACKENDS[backend]:
+            raise ValueError('the {} backend has no {} kernel'.format(backend, stage))
+    return {stage: BACKENDS[overrides.get(stage, default)].get(stage, BACKENDS[DEFAULT_BACKEND][stage])
+            for stage in STAGES}
+
+
+def get_kernel(stage):
+    """Returns the kernel of stage selected by the JPEG_KERNEL_BACKEND environment variable."""
+    return resolve_backends(os.environ.get(BACKEND_VARIABLE, DEFAULT_BACKEND))[stage]
+
+
+def select_backends(selection):
+    """Selects the kernels (see resolve_backends) for this process and the worker processes it starts."""
+    resolve_backends(selection)
+    # 写进环境变量，之后启动的子进程（restart_rows、batchCompress 的进程池）也使用同样的后端
+    os.environ[BACKEND_VARIABLE] = selection
+
+
+def available_backends():
+    """Returns the names of the backends that can be selected."""
+    return list(BACKENDS)
+
+
+register_kernel('numpy', 'dct')(take_dct_of_component)
+register_kernel('numpy', 'quantize')(quantize_component)
+register_kernel('numpy', 'symbols')(generate_symbols)
+register_kernel('numpy', 'huffman')(huffman_encode_symbols)
+register_kernel('numpy', 'pack')(pack_bits)
+
+
+@register_kernel('reference', 'dct')
+def reference_dct(component):
+    """Takes the DCT of a (..., 8, 8) component one block at a time."""
+    coefficients = numpy.empty(numpy.shape(component), dtype=numpy.float64)
+    for index in numpy.ndindex(*coefficients.shape[:-2]):
+        # 分两步进行，因为是二维离散变换，其实就是乘以了DCT变换矩阵
+        coefficients[index] = numpy.dot(numpy.dot(DCT_TABLE, component[index]), numpy.transpose(DCT_TABLE))
+    return coefficients
+
+
+@register_kernel('reference', 'quantize')
+def reference_quantize(component, reciprocal_table):
+    """Quantizes a (..., 8, 8) component one block at a time."""
+    quantized = numpy.empty(numpy.shape(component), dtype=numpy.int16)
+    for index in numpy.ndindex(*quantized.shape[:-2]):
+        quantized[index] = numpy.rint(component[index] * reciprocal_table)
+    return quantized
+
+
+@register_kernel('reference', 'symbols')
+def reference_symbols(blocks, block_components, dc_predictors=None):
+    """Generates the symbols of a scan with the original encode_dc, zigzag_all and run_length_encode."""
+    blocks = numpy.array(blocks, dtype=numpy.int32)
+    block_components = numpy.asarray(block_components)
+    predictors = list(dc_predictors) if dc_predictors is not None else [0] * 3
+    for component in numpy.unique(block_components):
+        indexes = numpy.flatnonzero(block_components == component)
+        component_blocks = blocks[indexes]
+        last_dc = int(component_blocks[-1][0][0])
+        # DPCM：encode_dc 减去同一通道上一个块的DC，第一个块再减去之前的条带留下的预测值
+        encode_dc(component_blocks)
+        component_blocks[0][0][0] -= predictors[component]
+        predictors[component] = last_dc
+        blocks[indexes] = component_blocks
+    symbols, bits, classes = [], [], []
+    for component, serial in zip(block_components, zigzag_all(blocks)):
+        for index, (symbol, extra_bits) in enumerate(run_length_encode([int(value) for value in serial])):
+            symbols.append(symbol)
+            bits.append(extra_bits)
+            classes.append(2 * component + (index > 0))
+    if dc_predictors is not None:
+        dc_predictors[:] = predictors
+    return (numpy.array(symbols, dtype=numpy.uint8), numpy.array(bits, dtype=numpy.uint16),
+            numpy.array(classes, dtype=numpy.uint8))
+
+
+@register_kernel('reference', 'huffman')
+def reference_huffman(symbols, bits, classes, class_tables):
+    """Looks up the codes block by block with the original huffman_encode (each block starts with a DC class)."""
+    values, lengths = [], []
+    block_starts = [index for index, symbol_class in enumerate(classes) if symbol_class % 2 == 0] + [len(classes)]
+    for start, end in zip(block_starts, block_starts[1:]):
+        run_length = [(int(symbol), int(extra_bits)) for symbol, extra_bits in zip(symbols[start:end], bits[start:end])]
+        huffman_encode(run_length, class_tables[classes[start]], class_tables[classes[start] + 1])
+        for code, length, extra_bits, extra_length in run_length:
+            values.append(code << extra_length | extra_bits)
+            lengths.append(length + extra_length)
+    return numpy.array(values, dtype=numpy.uint32), numpy.array(lengths, dtype=numpy.uint8)
+
+
+@register_kernel('reference', 'pack')
+def reference_pack(values, lengths):
+    """Packs the code words through the '0'/'1' string of the original dump_scan_to_string."""
+    scan_string = dump_scan_to_string([[(int(value), int(length), 0, 0)
+                                        for value, length in zip(values, lengths) if length]])
+    # Add throw away bits to make it end on a byte
+    scan_string += '1' * (-len(scan_string) % 8)
+    data = bytearray()
+    for start in range(0, len(scan_string), 8):
+        data.append(int(scan_string[start:start + 8], 2))
+        if data[-1] == 0xFF:
+            data.append(0x00)
+    return numpy.array(data, dtype=numpy.uint8)
+
+
+def _pack_bits_loop(values, lengths, packed):
+    """Packs the code words into packed (at least twice their byte count), returning the byte count."""
+    buffer = numpy.int64(0)
+    buffer_length = numpy.int64(0)
+    count = 0
+    for index in range(len(values)):
+        length = numpy.int64(lengths[index])
+        buffer = (buffer << length) | numpy.int64(values[index])
+        buffer_length += length
+        while buffer_length >= 8:
+            buffer_length -= 8
+            byte = (buffer >> buffer_length) & 0xFF
+            packed[count] = byte
+            count += 1
+            if byte == 0xFF:
+                packed[count] = 0x00
+                count += 1
+        buffer &= (numpy.int64(1) << buffer_length) - 1
+    if buffer_length:
+        # 最后不足一个字节的位用 1 补齐
+        padding = 8 - buffer_length
+        byte = ((buffer << padding) | ((numpy.int64(1) << padding) - 1)) & 0xFF
+        packed[count] = byte
+        count += 1
+        if byte == 0xFF:
+            packed[count] = 0x00
+            count += 1
+    return count
+
+
+if numba is not None:
+    _jit_pack_bits_loop = numba.njit(cache=True, nogil=True)(_pack_bits_loop)
+
+    @register_kernel('numba', 'pack')
+    def numba_pack(values, lengths):
+        """Packs the code words with the compiled scalar loop."""
+        lengths = numpy.ascontiguousarray(lengths, dtype=numpy.uint8)
+        byte_count = (int(lengths.sum(dtype=numpy.int64)) + 7) // 8
+        packed = numpy.empty(2 * byte_count, dtype=numpy.uint8)
+        count = _jit_pack_bits_loop(numpy.ascontiguousarray(values, dtype=numpy.uint32), lengths, packed)
+        return packed[:count]
+else:
+    UNAVAILABLE_BACKENDS['numba'] = 'numba is not installed'
+
+
+def _sample_images():
+    """Small images for check_backends: a noisy gradient, noise with an odd size and a flat one."""
+    rng = numpy.random.default_rng(0)
+    y, x = numpy.mgrid[0:48, 0:64]
+    gradient = numpy.stack([x * 4, y * 5, (x + y) * 2], axis=-1) + rng.normal(0, 6, (48, 64, 3))
+    return [('gradient', numpy.clip(gradient, 0, 255).astype(numpy.uint8)),
+            ('noise', rng.integers(0, 256, (37, 53, 3), dtype=numpy.uint8)),
+            ('flat', numpy.full((16, 24, 3), 200, dtype=numpy.uint8))]
+
+
+def _same(first, second):
+    """Whether two kernel results are byte for byte the same (including the dtypes)."""
+    if isinstance(first, tuple):
+        return isinstance(second, tuple) and len(first) == len(second) and all(map(_same, first, second))
+    first, second = numpy.asarray(first), numpy.asarray(second)
+    return first.dtype == second.dtype and first.shape == second.shape and first.tobytes() == second.tobytes()
+
+
+def check_backends(backends=None, log=print):
+    """Checks that every kernel and every whole encode of the backends match the NumPy backend byte for byte.
+
+    Each stage is run on the inputs the NumPy pipeline gives it for a few
+    small images, then the images are encoded end to end (baseline,
+    optimized, 4:2:0, restart interval, streaming and progressive) with the
+    backend selected for every stage.
+    :returns: list -- the (backend, stage or encode settings, image) mismatches.
+    """
+    import jpegEncoder
+    from inputImg import ArraySource, create_mcu_matrices
+
+    backends = [backend for backend in (backends or available_backends()) if backend != DEFAULT_BACKEND]
+    mismatches = []
+    numpy_kernels = BACKENDS[DEFAULT_BACKEND]
+    for name, pixels in _sample_images():
+        height, width = pixels.shape[0] // 8 * 8, pixels.shape[1] // 8 * 8
+        plan = jpegEncoder.get_encode_plan(50, width, height)
+        planes = ArraySource(pixels).read_planes(0, height, width)
+        blocks = [create_mcu_matrices(plane) for plane in planes]
+        coefficients = [numpy_kernels['dct'](component) for component in blocks]
+        quantized = [numpy_kernels['quantize'](coefficients[0], plan.l_reciprocals)]
+        quantized += [numpy_kernels['quantize'](chroma, plan.c_reciprocals) for chroma in coefficients[1:]]
+        interleaved = numpy.concatenate(quantized, axis=1).reshape(-1, 8, 8)
+        block_components = numpy.tile(plan.mcu_components, len(quantized[0]))
+        symbols = numpy_kernels['symbols'](interleaved, block_components, [0, 0, 0])
+        values, lengths = numpy_kernels['huffman'](*symbols, plan.class_tables)
+        stage_arguments = {
+            'dct': (blocks[0],),
+            'quantize': (coefficients[1], plan.c_reciprocals),
+            'symbols': (interleaved, block_components),
+            'huffman': symbols + (plan.class_tables,),
+            'pack': (values, lengths),
+        }
+        for backend in backends:
+            for stage, kernel in BACKENDS[backend].items():
+                if stage == 'symbols':
+                    # 继续一个扫描：DC 预测值要相同地更新
+                    expected_predictors, predictors = [5, -3, 2], [5, -3, 2]
+                    expected = numpy_kernels[stage](*stage_arguments[stage], expected_predictors)
+                    same = (_same(kernel(*stage_arguments[stage], predictors), expected)
+                            and predictors == expected_predictors)
+                else:
+                    expected = numpy_kernels[stage](*stage_arguments[stage])
+                    same = _same(kernel(*stage_arguments[stage]), expected)
+                log('{:<10} {:<8} {:<9} {}'.format(backend, stage, name, 'ok' if same else 'MISMATCH'))
+                if not same:
+                    mismatches.append((backend, stage, name))
+
+        for options in ({}, {'optimize_huffman': True}, {'sampling': '4:2:0'}, {'restart_rows': 1},
+                        {'streaming': True}, {'progressive': True}):
+            selection = os.environ.get(BACKEND_VARIABLE)
+            try:
+                select_backends(DEFAULT_BACKEND)
+                expected = jpegEncoder.encode(pixels, grayscale=False, **options).data
+                for backend in backends:
+                    select_backends(backend)
+                    same = jpegEncoder.encode(pixels, grayscale=False, **options).data == expected
+                    log('{:<10} {:<8} {:<9} {} {}'.format(backend, 'encode', name, options,
+                                                          'ok' if same else 'MISMATCH'))
+                    if not same:
+                        mismatches.append((backend, 'encode {}'.format(options), name))
+            finally:
+                if selection is None:
+                    os.environ.pop(BACKEND_VARIABLE, None)
+                else:
+                    os.environ[BACKEND_VARIABLE] = selection
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks that the kernel backends match the NumPy backend.')
+    parser.add_argument('backends', nargs='*', help='the backends to check (default: all available)')
+    args = parser.parse_args(argv)
+    for backend, reason in UNAVAILABLE_BACKENDS.items():
+        print('跳过 {} 后端：{}'.format(backend, reason))
+    for backend in args.backends:
+        if backend not in BACKENDS:
+            parser.error('unknown or unavailable backend: ' + backend)
+    mismatches = check_backends(args.backends)
+    print('全部一致' if not mismatches else '{} 处不一致'.format(len(mismatches)))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
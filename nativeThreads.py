@@ -0,0 +1,17 @@
+"""Limits the threads of the native numeric libraries (BLAS, OpenMP) used by numpy.
+
+Tools that get their parallelism from a pool of processes call
+limit_native_threads() before importing numpy, so that N processes do not
+each start N threads. Values already set in the environment are kept, so an
+operator can still choose them.
+"""
+import os
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def limit_native_threads(count=1):
+    """Sets every thread count variable that is not set yet to count (inherited by child processes)."""
+    for variable in THREAD_VARIABLES:
+        os.environ.setdefault(variable, str(count))
@@ -0,0 +1,197 @@
+"""Builds the scans of a progressive (SOF2) JPEG from quantized coefficients.
+
+A progressive file sends the coefficients in several scans: first the DC
+terms of every block (a 1/8 scale preview), then bands of AC coefficients,
+each at reduced precision (successive approximation, the low Al bits are
+held back) and later refined one bit at a time. The scan script is the one
+libjpeg uses by default (jpeg_simple_progression).
+
+Every scan is turned into flat arrays of items, like generate_symbols does
+for a baseline scan, but the items carry their extra bit count explicitly
+(EOB runs have it in the high nibble) and items of class RAW_BITS are bits
+written as they are (DC refinement and AC correction bits).
+"""
+import numpy
+
+from utils import MAGNITUDE_OFFSET, MAGNITUDE_CATEGORY, MAGNITUDE_BITS
+
+# 一个 EOBn 符号最多表示这么多个块的 EOB 游程
+MAX_EOB_RUN = 0x7FFF
+# 不经过哈夫曼编码、原样输出的位（DC 细化位、AC 修正位）的类别
+RAW_BITS = -1
+
+# 每个扫描是 (通道, Ss, Se, Ah, Al)：频谱选择的起止位置（Zigzag 序号）和逐次逼近的前后位数
+COLOR_SCAN_SCRIPT = (
+    ((0, 1, 2), 0, 0, 0, 1),  # 所有通道的 DC，少送最低一位
+    ((0,), 1, 5, 0, 2),
+    ((2,), 1, 63, 0, 1),
+    ((1,), 1, 63, 0, 1),
+    ((0,), 6, 63, 0, 2),
+    ((0,), 1, 63, 2, 1),  # 亮度 AC 细化一位
+    ((0, 1, 2), 0, 0, 1, 0),  # DC 的最低一位
+    ((2,), 1, 63, 1, 0),
+    ((1,), 1, 63, 1, 0),
+    ((0,), 1, 63, 1, 0),
+)
+GRAYSCALE_SCAN_SCRIPT = (
+    ((0,), 0, 0, 0, 1),
+    ((0,), 1, 5, 0, 2),
+    ((0,), 6, 63, 0, 2),
+    ((0,), 1, 63, 2, 1),
+    ((0,), 0, 0, 1, 0),
+    ((0,), 1, 63, 1, 0),
+)
+
+
+def dc_first_scan(dc_values, block_components, al):
+    """Returns the items of the first scan of the DC terms (in scan order).
+
+    :param dc_values: the (N,) quantized DC terms of the blocks in scan order.
+    :param block_components: the (N,) component of each block (0 for Y).
+    :param al: the number of low bits held back.
+    :returns: tuple -- (symbols, bits, extra_lengths, classes) arrays, the
+        class being the huffman table slot (0 for luminance, 1 for chrominance).
+    """
+    # DC 的点变换是算术右移；DPCM 按通道分别计算（Cb、Cr 共用一张表但各有各的预测值），每个通道从 0 开始
+    values = dc_values.astype(numpy.int32) >> al
+    diffs = numpy.empty_like(values)
+    for component in numpy.unique(block_components):
+        mask = block_components == component
+        diffs[mask] = numpy.diff(values[mask], prepend=0)
+    indexes = diffs + MAGNITUDE_OFFSET
+    symbols = MAGNITUDE_CATEGORY[indexes]
+    return (symbols, MAGNITUDE_BITS[indexes].astype(numpy.uint32), symbols,
+            numpy.minimum(block_components, 1).astype(numpy.int8))
+
+
+def dc_refine_scan(dc_values, al):
+    """Returns the items of a DC refinement scan: bit al of every DC term, as raw bits."""
+    count = len(dc_values)
+    bits = (dc_values.astype(numpy.int32) >> al) & 1
+    return (numpy.zeros(count, dtype=numpy.uint8), bits.astype(numpy.uint32), numpy.ones(count, dtype=numpy.uint8),
+            numpy.full(count, RAW_BITS, dtype=numpy.int8))
+
+
+def ac_scan(zigzag_blocks, ss, se, ah, al):
+    """Returns the items of a first (ah == 0) or refinement AC scan of one component.
+
+    :param zigzag_blocks: the (N, 64) quantized coefficients of the blocks of
+        the component, in zigzag order and raster (non-interleaved) order.
+    :param ss: the first and se the last zigzag position of the band.
+    :param ah: the bit position of the previous scan of the band (0 if none)
+        and al the one of this scan.
+    :returns: tuple -- (symbols, bits, extra_lengths, classes) arrays in
+        output order, the huffman coded items having class 0.
+    """
+    band = zigzag_blocks[:, ss:se + 1].astype(numpy.int32)
+    count, length = band.shape
+    # AC 的点变换是绝对值右移（向零取整）
+    magnitudes = numpy.abs(band) >> al
+    if ah:
+        # 细化扫描：新出现的非零系数绝对值只能是 1，之前已非零的系数只送一位修正位
+        new = magnitudes == 1
+        history = magnitudes > 1
+    else:
+        new = magnitudes != 0
+        history = None
+    zero_counts = numpy.cumsum(magnitudes == 0, axis=1)
+    new_counts = numpy.cumsum(new, axis=1)
+    block_new_counts = new_counts[:, -1]
+    block_first_new = numpy.cumsum(block_new_counts) - block_new_counts
+
+    # 每个新非零系数之前（从上一个新非零系数算起）的零个数，只数之前也为零的系数
+    rows, columns = numpy.nonzero(new)
+    segments = new_counts[rows, columns] - 1
+    zeros_before = zero_counts[rows, columns]
+    segment_start_zeros = numpy.zeros_like(zeros_before)
+    segment_start_zeros[1:] = zeros_before[:-1]
+    segment_start_zeros[segments == 0] = 0
+    runs = zeros_before - segment_start_zeros
+    zrl_counts = runs >> 4
+    if ah:
+        sizes = numpy.ones(len(rows), dtype=numpy.uint8)
+        value_bits = (band[rows, columns] > 0).astype(numpy.uint32)  # 符号位：正数为 1
+    else:
+        indexes = numpy.where(band[rows, columns] < 0, -magnitudes[rows, columns], magnitudes[rows, columns])
+        indexes += MAGNITUDE_OFFSET
+        sizes = MAGNITUDE_CATEGORY[indexes]
+        value_bits = MAGNITUDE_BITS[indexes].astype(numpy.uint32)
+
+    # 输出顺序由排序键决定：块、段（第几个新非零系数，块尾为 64）、段内第几个符号
+    # （ZRL 在前）、符号还是修正位、系数位置
+    def keys(blocks, segments, emissions, kinds, positions):
+        return (((blocks.astype(numpy.int64) * 65 + segments) * 4 + emissions) * 2 + kinds) * 64 + positions
+
+    parts = [(keys(rows, segments, zrl_counts, 0, columns),
+              (((runs & 0x0F) << 4) | sizes).astype(numpy.uint8), value_bits, sizes,
+              numpy.zeros(len(rows), dtype=numpy.int8))]
+
+    zrl_total = int(zrl_counts.sum())
+    if zrl_total:
+        owners = numpy.repeat(numpy.arange(len(rows)), zrl_counts)
+        emissions = numpy.arange(zrl_total) - numpy.repeat(numpy.cumsum(zrl_counts) - zrl_counts, zrl_counts)
+        parts.append((keys(rows[owners], segments[owners], emissions, 0, 0),
+                      numpy.full(zrl_total, 0xF0, dtype=numpy.uint8), numpy.zeros(zrl_total, dtype=numpy.uint32),
+                      numpy.zeros(zrl_total, dtype=numpy.uint8), numpy.zeros(zrl_total, dtype=numpy.int8)))
+
+    if history is not None:
+        # 修正位跟在解码器经过这个系数之后读到的第一个符号后面：同一段中它之前每 16 个零
+        # 发出一个 ZRL，之后的修正位随下一个 ZRL 或新系数发出；最后一个新系数之后的随 EOB 发出
+        history_rows, history_columns = numpy.nonzero(history)
+        history_segments = new_counts[history_rows, history_columns]
+        trailing = history_segments == block_new_counts[history_rows]
+        previous_new = block_first_new[history_rows] + history_segments - 1
+        start_zeros = numpy.where(history_segments > 0, zeros_before[numpy.maximum(previous_new, 0)]
+                                  if len(zeros_before) else 0, 0)
+        emissions = (zero_counts[history_rows, history_columns] - start_zeros) >> 4
+        history_count = len(history_rows)
+        parts.append((keys(history_rows, numpy.where(trailing, 64, history_segments),
+                           numpy.where(trailing, 0, emissions), 1, history_columns),
+                      numpy.zeros(history_count, dtype=numpy.uint8),
+                      (magnitudes[history_rows, history_columns] & 1).astype(numpy.uint32),
+                      numpy.ones(history_count, dtype=numpy.uint8), numpy.full(history_count, RAW_BITS, dtype=numpy.int8)))
+
+    # 最后一个位置不是新非零系数的块以 EOB 结尾；连续的这类块（之后的块没有新系数）合成一个
+    # EOB 游程，EOBn 符号写在游程第一个块的符号之后，再接着游程中所有块尾部的修正位
+    eob = ~new[:, -1]
+    starts = eob & (block_new_counts > 0)
+    starts[0] = eob[0]
+    starts[1:] |= eob[1:] & ~eob[:-1]
+    block_indexes = numpy.arange(count)
+    run_starts = numpy.maximum.accumulate(numpy.where(starts, block_indexes, 0))
+    run_ids = numpy.cumsum(starts) - 1
+    run_lengths = numpy.bincount(run_ids[eob], minlength=int(starts.sum()))
+    offsets = block_indexes - run_starts
+    chunk_starts = eob & (offsets % MAX_EOB_RUN == 0)
+    eob_blocks = block_indexes[chunk_starts]
+    eob_runs = numpy.minimum(run_lengths[run_ids[chunk_starts]] - offsets[chunk_starts], MAX_EOB_RUN)
+    eob_sizes = (numpy.frexp(eob_runs)[1] - 1).astype(numpy.uint8)  # EOBn 的 n：游程长度的位数减一
+    eob_count = len(eob_blocks)
+    parts.append((keys(eob_blocks, 64, 0, 0, 0), (eob_sizes << 4).astype(numpy.uint8),
+                  (eob_runs - (1 << eob_sizes.astype(numpy.int64))).astype(numpy.uint32), eob_sizes,
+                  numpy.zeros(eob_count, dtype=numpy.int8)))
+
+    order = numpy.argsort(numpy.concatenate([part[0] for part in parts]), kind='stable')
+    return tuple(numpy.concatenate([part[index] for part in parts])[order] for index in range(1, 5))
+
+
+def count_scan_frequencies(symbols, classes, table_count):
+    """Counts the huffman coded symbols of a scan per table slot, as a (table_count, 256) array."""
+    coded = classes != RAW_BITS
+    counts = numpy.bincount(classes[coded].astype(numpy.int64) * 256 + symbols[coded], minlength=table_count * 256)
+    return counts.reshape(table_count, 256)
+
+
+def encode_scan_items(symbols, bits, extra_lengths, classes, class_tables):
+    """Looks up the huffman code of every item and appends its extra bits.
+
+    :param class_tables: the compiled (codes, lengths) table of each slot.
+    :returns: tuple -- (values, lengths) arrays for pack_bits.
+    """
+    # 在最后加一张全为 0 的表，RAW_BITS (-1) 的项就只剩下它的位
+    codes = numpy.stack([table[0] for table in class_tables] + [numpy.zeros(256, dtype=numpy.uint32)])
+    code_lengths = numpy.stack([table[1] for table in class_tables] + [numpy.zeros(256, dtype=numpy.uint8)])
+    extra_lengths = extra_lengths.astype(numpy.uint32)
+    values = (codes[classes, symbols].astype(numpy.uint32) << extra_lengths) | bits
+    lengths = code_lengths[classes, symbols] + extra_lengths
+    return values, lengths
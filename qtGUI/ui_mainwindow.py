@@ -36,10 +36,16 @@ class Ui_MainWindow(object):
         self.imgFilePathEdit.setText("")
         self.imgFilePathEdit.setObjectName("imgFilePathEdit")
         self.compressButton = QtWidgets.QPushButton(self.widget)
-        self.compressButton.setGeometry(QtCore.QRect(10, 140, 331, 31))
+        self.compressButton.setGeometry(QtCore.QRect(10, 140, 251, 31))
         self.compressButton.setStyleSheet("background-color: rgb(50, 67, 71);\n"
 "color: rgb(255, 255, 255);")
         self.compressButton.setObjectName("compressButton")
+        self.cancelButton = QtWidgets.QPushButton(self.widget)
+        self.cancelButton.setEnabled(False)
+        self.cancelButton.setGeometry(QtCore.QRect(270, 140, 71, 31))
+        self.cancelButton.setStyleSheet("background-color: rgb(50, 67, 71);\n"
+"color: rgb(255, 255, 255);")
+        self.cancelButton.setObjectName("cancelButton")
         self.label_2 = QtWidgets.QLabel(self.widget)
         self.label_2.setGeometry(QtCore.QRect(10, 80, 54, 12))
         self.label_2.setStyleSheet("color: rgb(255, 255, 255);")
@@ -76,11 +82,15 @@ class Ui_MainWindow(object):
         self.groupBox_3.setStyleSheet("color: rgb(255, 255, 255);")
         self.groupBox_3.setObjectName("groupBox_3")
         self.logtextBrowser = QtWidgets.QTextBrowser(self.groupBox_3)
-        self.logtextBrowser.setGeometry(QtCore.QRect(10, 20, 201, 181))
+        self.logtextBrowser.setGeometry(QtCore.QRect(10, 20, 201, 161))
         self.logtextBrowser.setToolTip("")
         self.logtextBrowser.setStyleSheet("background-color: rgb(255, 255, 255);\n"
 "color: rgb(0, 0, 0);")
         self.logtextBrowser.setObjectName("logtextBrowser")
+        self.progressBar = QtWidgets.QProgressBar(self.groupBox_3)
+        self.progressBar.setGeometry(QtCore.QRect(10, 186, 201, 16))
+        self.progressBar.setProperty("value", 0)
+        self.progressBar.setObjectName("progressBar")
         self.openFilePathButton = QtWidgets.QPushButton(self.groupBox_3)
         self.openFilePathButton.setGeometry(QtCore.QRect(214, 20, 111, 23))
         self.openFilePathButton.setObjectName("openFilePathButton")
@@ -118,6 +128,7 @@ class Ui_MainWindow(object):
         self.label.setText(_translate("MainWindow", "图像路径："))
         self.imgFilePathEdit.setPlaceholderText(_translate("MainWindow", "图像文件的绝对路径..."))
         self.compressButton.setText(_translate("MainWindow", "开始压缩"))
+        self.cancelButton.setText(_translate("MainWindow", "取消"))
         self.label_2.setText(_translate("MainWindow", "质量因子："))
         self.quantityLabel.setText(_translate("MainWindow", "50%"))
         self.groupBox.setTitle(_translate("MainWindow", "原始文件："))
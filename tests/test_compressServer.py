@@ -0,0 +1,87 @@
+"""Checks that the early error responses of compressServer reach clients still sending their body."""
+import asyncio
+import http.client
+import io
+import threading
+import time
+import unittest
+
+import numpy
+import PIL.Image
+
+import compressServer
+
+LARGE_BODY = bytes(9 * 1024 * 1024)
+
+
+class EarlyErrorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # 一个工作进程、队列长度 1：一个在编码、一个在排队时队列就满了
+        cls.loop = asyncio.new_event_loop()
+        cls.server = compressServer.CompressServer(workers=1, queue_size=1)
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(cls.loop)
+            cls.loop.run_until_complete(cls.server.start('127.0.0.1', 0))
+            started.set()
+            cls.loop.run_forever()
+
+        cls.thread = threading.Thread(target=run, daemon=True)
+        cls.thread.start()
+        started.wait()
+        cls.port = cls.server.server.sockets[0].getsockname()[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run_coroutine_threadsafe(cls.server.close(), cls.loop).result()
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+
+    def post(self, query, body):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request('POST', '/compress?' + query, body)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def post_until_cut_off(self, query, body):
+        try:
+            self.post(query, body)
+        except (http.client.HTTPException, OSError):
+            pass  # 已经发出部分 JPEG 之后超时，响应被截断
+
+    def test_invalid_parameter_with_a_large_body_gets_400(self):
+        status, text = self.post('quality=500', LARGE_BODY)
+        self.assertEqual(status, 400)
+        self.assertIn(b'quality', text)
+
+    def test_full_queue_gets_503(self):
+        # 编码需要好几秒的大图（PNG 压缩后很小），timeout 到了就取消
+        rows, columns = numpy.mgrid[0:4000, 0:4000]
+        pixels = numpy.stack([columns % 256, rows % 256, (rows + columns) % 256], -1).astype(numpy.uint8)
+        image = io.BytesIO()
+        PIL.Image.fromarray(pixels).save(image, 'PNG')
+        slow = [threading.Thread(target=self.post_until_cut_off, args=('trellis=true&timeout=3', image.getvalue()))
+                for _ in range(2)]
+        for thread in slow:
+            thread.start()
+        # 等一个请求开始编码、另一个排进队列
+        pool = self.server.pool
+        deadline = time.time() + 10
+        while not (pool.busy and pool.queue.full()) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(pool.busy and pool.queue.full())
+        status, _ = self.post('quality=50', LARGE_BODY)
+        self.assertEqual(status, 503)
+        for thread in slow:
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
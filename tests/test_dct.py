@@ -0,0 +1,40 @@
+"""Checks the fixed-point AAN DCT against the float DCT."""
+import itertools
+import unittest
+
+import numpy
+
+from compressAlgorithm import AAN_MAX_ERROR, take_dct_of_component, take_aan_dct_of_component, \
+    aan_quantization_table
+
+
+class AanDctTest(unittest.TestCase):
+
+    def assert_within_bound(self, blocks):
+        # 除以折入了 AAN 缩放的全 1 量化表，得到真实的DCT系数
+        aan = take_aan_dct_of_component(blocks) / aan_quantization_table(numpy.ones((8, 8)))
+        error = numpy.abs(aan - take_dct_of_component(blocks)).max()
+        self.assertLessEqual(error, AAN_MAX_ERROR)
+
+    def test_random_blocks(self):
+        random = numpy.random.default_rng(0)
+        self.assert_within_bound(random.integers(-128, 128, (100000, 8, 8)).astype(numpy.float64))
+
+    def test_extreme_blocks(self):
+        # 只取 -128 和 127 的块：全部相同、棋盘格、所有的行或列图案，以及随机组合
+        extremes = numpy.array([-128.0, 127.0])
+        patterns = numpy.array(list(itertools.product(extremes, repeat=8)))
+        checkerboard = extremes[numpy.add.outer(numpy.arange(8), numpy.arange(8)) % 2]
+        random = numpy.random.default_rng(1)
+        blocks = numpy.concatenate([
+            numpy.full((2, 8, 8), extremes[:, None, None]),
+            numpy.stack([checkerboard, checkerboard[::-1]]),
+            numpy.broadcast_to(patterns[:, None, :], (len(patterns), 8, 8)),
+            numpy.broadcast_to(patterns[:, :, None], (len(patterns), 8, 8)),
+            extremes[random.integers(0, 2, (100000, 8, 8))],
+        ])
+        self.assert_within_bound(blocks)
+
+
+if __name__ == '__main__':
+    unittest.main()
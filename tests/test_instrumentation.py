@@ -0,0 +1,37 @@
+"""Checks the memory peaks of overlapping instrumented stages."""
+import unittest
+
+import numpy
+
+from instrumentation import Instrumentation
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_overlapping_stages_keep_their_peaks(self):
+        first, second = Instrumentation(trace_memory=True), Instrumentation(trace_memory=True)
+        with first.encoding():
+            with first.stage('first'):
+                numpy.ones(4 * 1024 * 1024, dtype=numpy.uint8)  # 4 MB，用完即释放
+                # 另一个编码的阶段（如另一个线程中）在此期间开始和结束，不能清掉第一个阶段的峰值
+                with second.encoding():
+                    with second.stage('second'):
+                        pass
+        self.assertGreaterEqual(first.stages['first'].peak_memory, 4 * 1024 * 1024)
+        self.assertGreaterEqual(second.stages['second'].peak_memory, 0)
+
+    def test_tracing_lasts_until_the_last_encode_ends(self):
+        first, second = Instrumentation(trace_memory=True), Instrumentation(trace_memory=True)
+        # 第一个编码先开始也先结束，第二个编码之后的阶段仍要跟踪内存
+        first_encode, second_encode = first.encoding(), second.encoding()
+        first_encode.__enter__()
+        second_encode.__enter__()
+        first_encode.__exit__(None, None, None)
+        with second.stage('after'):
+            numpy.ones(1024 * 1024, dtype=numpy.uint8)
+        second_encode.__exit__(None, None, None)
+        self.assertGreaterEqual(second.stages['after'].peak_memory, 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Checks the argument checks of jpegEncoder.encode and the encoding of images that are not whole MCUs."""
+import io
+import unittest
+
+import numpy
+import PIL.Image
+
+import jpegEncoder
+
+
+class QualityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pixels = numpy.random.default_rng(0).integers(0, 256, (16, 16, 3), dtype=numpy.uint8)
+
+    def test_out_of_range_quality_is_rejected(self):
+        for quality in (jpegEncoder.MIN_QUALITY - 1, jpegEncoder.MAX_QUALITY + 1, 2.5, None):
+            with self.assertRaises(ValueError):
+                jpegEncoder.encode(self.pixels, quality=quality)
+            with self.assertRaises(ValueError):
+                jpegEncoder.get_encode_plan(quality, 16, 16)
+
+    def test_quality_limits_are_accepted(self):
+        for quality in (jpegEncoder.MIN_QUALITY, jpegEncoder.MAX_QUALITY):
+            self.assertEqual(jpegEncoder.encode(self.pixels, quality=quality).quality, quality)
+
+
+class PartialMcuTest(unittest.TestCase):
+
+    MODES = ({}, {'streaming': True}, {'restart_rows': 1}, {'progressive': True}, {'target_size': 2000},
+             {'optimize_huffman': True}, {'grayscale': True})
+
+    def encode_and_decode(self, pixels, **options):
+        stats = jpegEncoder.encode(pixels, quality=0, **options)
+        image = PIL.Image.open(io.BytesIO(stats.data))
+        image.load()
+        return stats, numpy.asarray(image.convert('RGB'), dtype=numpy.int64)
+
+    def test_images_smaller_than_an_mcu_keep_their_size(self):
+        for width, height in ((1, 1), (4, 4), (7, 9), (8, 8), (12, 20), (17, 33)):
+            # 平滑的渐变，除了补齐以外的误差都很小
+            rows, columns = numpy.mgrid[0:height, 0:width]
+            pixels = numpy.stack([100 + 3 * columns, 100 + 3 * rows, 100 + columns + rows], -1).astype(numpy.uint8)
+            for sampling in ('4:4:4', '4:2:0'):
+                for options in self.MODES:
+                    with self.subTest(width=width, height=height, sampling=sampling, **options):
+                        stats, decoded = self.encode_and_decode(pixels, sampling=sampling, **options)
+                        self.assertEqual((stats.width, stats.height), (width, height))
+                        self.assertEqual(decoded.shape, (height, width, 3))
+                        if not options.get('grayscale'):
+                            self.assertLess(numpy.abs(decoded - pixels).max(), 8)
+
+    def test_padding_repeats_the_edge_pixels(self):
+        # 右下角的像素是白色：用黑色补齐时，解码出的边缘会变暗
+        pixels = numpy.full((9, 9), 255, dtype=numpy.uint8)
+        _, decoded = self.encode_and_decode(pixels)
+        self.assertGreater(decoded.min(), 250)
+
+    def test_empty_image_is_rejected(self):
+        for shape in ((0, 8, 3), (8, 0, 3)):
+            with self.assertRaises(ValueError):
+                jpegEncoder.encode(numpy.zeros(shape, dtype=numpy.uint8))
+        with self.assertRaises(ValueError):
+            jpegEncoder.get_encode_plan(50, 0, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+"""Checks that every kernel backend gives the same bytes as the NumPy one."""
+import os
+import unittest
+
+import kernelBackends
+
+
+class KernelBackendsTest(unittest.TestCase):
+
+    def test_backends_match_numpy(self):
+        selection = os.environ.get(kernelBackends.BACKEND_VARIABLE)
+        mismatches = kernelBackends.check_backends(log=lambda message: None)
+        self.assertEqual(mismatches, [])
+        # check_backends 结束后恢复原来选择的后端
+        self.assertEqual(os.environ.get(kernelBackends.BACKEND_VARIABLE), selection)
+
+    def test_reference_backend_is_checked(self):
+        self.assertIn('reference', kernelBackends.available_backends())
+
+    def test_resolve_backends(self):
+        kernels = kernelBackends.resolve_backends('reference,pack=numpy')
+        self.assertIs(kernels['symbols'], kernelBackends.BACKENDS['reference']['symbols'])
+        self.assertIs(kernels['pack'], kernelBackends.BACKENDS['numpy']['pack'])
+        with self.assertRaises(ValueError):
+            kernelBackends.resolve_backends('numpy,entropy=reference')
+        with self.assertRaises(ValueError):
+            kernelBackends.resolve_backends('no-such-backend')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+"""Checks that trellis quantization never costs more bits than rounding at the same distortion."""
+import io
+import os
+import unittest
+
+import numpy
+import PIL.Image
+
+import jpegEncoder
+
+TEST_IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testBMP', '1-compress0.jpg')
+
+
+class TrellisTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # 取测试图中间一块，既有平坦区域也有细节
+        with PIL.Image.open(TEST_IMAGE) as image:
+            cls.pixels = numpy.asarray(image.convert('RGB').crop((704, 284, 1216, 796)))
+
+    def encode(self, quality, trellis):
+        """Returns (size in bytes, mean squared error) of an encode of the test image."""
+        stats = jpegEncoder.encode(self.pixels, quality=quality, sampling='4:2:0', optimize_huffman=True,
+                                   grayscale=False, trellis=trellis)
+        with PIL.Image.open(io.BytesIO(stats.data)) as image:
+            decoded = numpy.asarray(image.convert('RGB'), dtype=numpy.float64)
+        return stats.output_size, numpy.mean((decoded - self.pixels) ** 2)
+
+    def test_smaller_than_rounding_at_equal_distortion(self):
+        # 直接取整的率失真曲线，在 trellis 的失真处插值得到同样失真下的大小
+        plain = sorted((self.encode(quality, False) for quality in range(0, 101, 2)), key=lambda point: point[1])
+        for quality in (0, 20, 30, 40, 45, 50, 60, 70, 90, 100):
+            size, error = self.encode(quality, True)
+            plain_size = numpy.interp(error, [point[1] for point in plain], [point[0] for point in plain])
+            self.assertLessEqual(size, plain_size, 'quality {}: {} bytes against {:.0f} bytes without trellis'
+                                 .format(quality, size, plain_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
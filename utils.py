@@ -1,7 +1,10 @@
 """Defines some helper functions for JPEG compression."""
+import collections
 import os
 import time
 
+import numpy
+
 ZIGZAG_ORDER = [(0, 0), (0, 1), (1, 0), (2, 0), (1, 1), (0, 2), (0, 3), (1, 2),
                 (2, 1), (3, 0), (4, 0), (3, 1), (2, 2), (1, 3), (0, 4), (0, 5),
                 (1, 4), (2, 3), (3, 2), (4, 1), (5, 0), (6, 0), (5, 1), (4, 2),
@@ -10,6 +13,11 @@ ZIGZAG_ORDER = [(0, 0), (0, 1), (1, 0), (2, 0), (1, 1), (0, 2), (0, 3), (1, 2),
                 (3, 5), (2, 6), (1, 7), (2, 7), (3, 6), (4, 5), (5, 4), (6, 3),
                 (7, 2), (7, 3), (6, 4), (5, 5), (4, 6), (3, 7), (4, 7), (5, 6),
                 (6, 5), (7, 4), (7, 5), (6, 6), (5, 7), (6, 7), (7, 6), (7, 7)]
+# 按 Zigzag 顺序排列的展平下标（row * 8 + column），用于一次性重排整个块序列
+ZIGZAG_INDEX = numpy.array([row * 8 + column for row, column in ZIGZAG_ORDER])
+
+# 幅值编码查找表的偏移：下标为 value + MAGNITUDE_OFFSET，覆盖 8 位图像可能出现的全部系数（包括DC差分）
+MAGNITUDE_OFFSET = 2047
 
 
 def getFileInfo(path):
@@ -47,6 +55,25 @@ def get_FileModifyTime(filePath):
     return TimeStampToTime(t)
 
 
+def map_in_order(executor, function, arguments, window):
+    """Like executor.map, but keeps at most window tasks in flight.
+
+    Results are yielded in the order of arguments (each an argument tuple). If
+    executor is None the calls are made in this process.
+    """
+    if executor is None:
+        for args in arguments:
+            yield function(*args)
+        return
+    pending = collections.deque()
+    for args in arguments:
+        pending.append(executor.submit(function, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 def get_huffman_table_bit_string(huffman_table):
     """Returns the huffman table bit string suitable for a jpeg file."""
     table_string = ''
@@ -90,6 +117,16 @@ def get_huffman_table_bit_string(huffman_table):
     return table_string
 
 
+def get_huffman_table_bytes(huffman_table):
+    """Returns the DHT bytes of a huffman table: 16 counts of codes per length, then the symbols by code."""
+    # 与 get_huffman_table_bit_string 的顺序相同：码长从短到长，同一码长内按码字排序
+    codes = sorted((len(code), code, symbol) for symbol, code in huffman_table.items())
+    length_counts = [0] * 16
+    for code_length, _, _ in codes:
+        length_counts[code_length - 1] += 1
+    return bytes(length_counts) + bytes(symbol for _, _, symbol in codes)
+
+
 def get_magnitude_dc(value):
     """Returns the 1 byte magnitude for a DC pixel."""
     if value < 1:
@@ -119,3 +156,21 @@ def get_ones_complement_bit_string(value):
                 bit_list[index] = '0'
         bit_string = ''.join(bit_list)
     return bit_string
+
+
+def build_magnitude_tables():
+    """Builds the (category, ones complement bits) lookup arrays for every coefficient value.
+
+    Index both arrays with value + MAGNITUDE_OFFSET. The category is what
+    get_magnitude_dc returns and the bits are the integer form of
+    get_ones_complement_bit_string (its length is the category).
+    """
+    values = numpy.arange(-MAGNITUDE_OFFSET, MAGNITUDE_OFFSET + 1)
+    # frexp 返回的指数就是 |value| 的二进制位数
+    categories = numpy.frexp(numpy.abs(values))[1].astype(numpy.uint8)
+    # 负数取反码：value - 1 的低 category 位
+    bits = numpy.where(values < 0, values - 1 + (1 << categories.astype(numpy.int64)), values)
+    return categories, bits.astype(numpy.uint16)
+
+
+MAGNITUDE_CATEGORY, MAGNITUDE_BITS = build_magnitude_tables()